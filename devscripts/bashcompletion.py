@@ -7,21 +7,50 @@ here = os.path.abspath(os.path.dirname(__file__))
 sys.path.insert(0, os.path.join(here, '..'))
 
 
-from flapjack import commands  # noqa
+from flapjack import commands, registry  # noqa
 
 
 BASH_COMPLETION_TEMPLATE = os.path.join(here, 'bash-completion.in')
 BASH_COMPLETION_FILE = os.path.join(here, '..', 'build',
                                     'flapjack.bash-completion')
 
+# Completion for a command whose parameter is one of a fixed set of words
+CHOICES_TEMPLATE = '''    elif [[ ${{prev}} == "{name}" ]]; then
+        COMPREPLY=( $(compgen -W "${{help_options}} {choices}" -- ${{cur}}) )
+        return 0
+'''
+
+
+def check_registry():
+    """The registry describes the commands without importing them, so make
+    sure that it matches the command classes."""
+    errors = []
+    for name, (description, _) in sorted(registry.COMMANDS.items()):
+        klass = commands._command_registry.get(name)
+        if klass is None:
+            errors.append('{} is in the registry, but not registered'
+                          .format(name))
+        elif klass.__doc__ != description:
+            errors.append('Description of {} out of sync with registry'
+                          .format(name))
+    for name in sorted(set(commands._command_registry) -
+                       set(registry.COMMANDS)):
+        errors.append('{} is registered, but not in the registry'
+                      .format(name))
+    if errors:
+        sys.exit('\n'.join(errors))
+
 
 def get_command_vars():
-    all_commands = commands.get_all_commands()
+    all_commands = registry.get_all_commands()
     return {
         'SUBCOMMANDS': ' '.join(all_commands['all']),
         'SUBCOMMANDS_MODULE_MATCH': '|'.join(all_commands['requiring module']),
         'SUBCOMMANDS_APPS_MATCH': '|'.join(all_commands['requiring app']),
         'SUBCOMMANDS_OTHER_MATCH': '|'.join(all_commands['no params']),
+        'SUBCOMMANDS_CHOICES': ''.join(
+            CHOICES_TEMPLATE.format(name=name, choices=' '.join(choices))
+            for name, choices in sorted(all_commands['choices'].items())),
     }
 
 
@@ -41,6 +70,7 @@ def write_script(script_text):
         script_file.write(script_text)
 
 
+check_registry()
 template_vars = get_command_vars()
 script_text = fill_template(template_vars)
 write_script(script_text)
@@ -0,0 +1,265 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+"""Measures flapjack's own overhead, without a real flatpak installation or
+network access. Stand-in git, flatpak, flatpak-builder, and ostree
+executables are put on PATH; they log every call and wait a fixed latency.
+The stand-in git then runs the real git, since flapjack needs its output.
+flapjack is then run against synthetic manifests of increasing size, with
+included files, nested modules, and comments. For each command, the wall time
+and the number of processes spawned are reported.
+
+Usage: python3 devscripts/benchmark.py [--sizes=10,100,500,2000]"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.abspath(os.path.dirname(__file__))
+toplevel = os.path.join(here, '..')
+
+SDK_ID = 'org.gnome.Sdk'
+DEV_SDK_ID = 'org.gnome.dev.Sdk'
+
+# Commit of the installed runtimes, and of the dev SDK that gets exported
+COMMIT = '0123456789ab' + '0' * 52
+
+FAKE_PREAMBLE = '''#!/bin/sh
+echo "$(basename "$0") $*" >> "$FAKE_LOG"
+sleep "$FAKE_LATENCY"
+'''
+
+FAKES = {
+    'git': 'exec "$REAL_GIT" "$@"\n',
+    'flatpak': '''case "$1" in
+  list) cat "$FAKE_INSTALLED" ;;
+  remotes) printf 'gnome-nightly\\tuser\\n' ;;
+  remote-ls) echo {sdk}/x86_64/master ;;
+esac
+'''.format(sdk=SDK_ID),
+    'flatpak-builder': '''echo "Downloading sources"
+echo "Starting build of {dev_sdk}"
+echo "Cleaning up"
+echo "Finishing {dev_sdk}"
+echo "Exporting {dev_sdk} to repo"
+while [ $# -gt 0 ]; do
+  if [ "$1" = --repo ]; then
+    for ref in {dev_sdk} {dev_sdk}.Debug; do
+      mkdir -p "$2/refs/heads/runtime/$ref/x86_64"
+      echo {commit} > "$2/refs/heads/runtime/$ref/x86_64/master"
+    done
+  fi
+  shift
+done
+'''.format(dev_sdk=DEV_SDK_ID, commit=COMMIT),
+    'ostree': '''if [ "$1" = init ]; then
+  for arg; do
+    case "$arg" in --repo=*) repo="${arg#--repo=}" ;; esac
+  done
+  [ -z "$repo" ] && repo="$3"
+  mkdir -p "$repo" && touch "$repo/config"
+fi
+''',
+}
+
+# Modules opened for development in each benchmark
+OPEN_MODULES = 3
+
+# Every nth module is included from a file of its own, with a nested module
+INCLUDE_EVERY = 5
+
+
+def write_fakes(bindir):
+    os.makedirs(bindir)
+    for name, body in FAKES.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(FAKE_PREAMBLE + body)
+        os.chmod(path, 0o755)
+
+
+def git(path, *args):
+    subprocess.check_call(['git'] + list(args), cwd=path,
+                          stdout=subprocess.DEVNULL)
+
+
+def make_upstream(path):
+    """A small git repo that all the synthetic modules are cloned from."""
+    os.makedirs(path)
+    git(path, 'init', '--quiet')
+    for name in ('configure.ac', 'Makefile.am', 'main.c'):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('/* {} */\n'.format(name))
+    git(path, 'add', '.')
+    git(path, '-c', 'user.name=Benchmark', '-c', 'user.email=b@localhost',
+        'commit', '--quiet', '-m', 'Initial commit')
+
+
+def module_json(name, upstream, indent):
+    pad = ' ' * indent
+    return ('{pad}/* Module {name} */\n'
+            '{pad}{{\n'
+            '{pad}    "name": "{name}", // the module name\n'
+            '{pad}    "config-opts": ["--disable-gtk-doc"],\n'
+            '{pad}    "sources": [{{"type": "git", "url": "{url}"}}]\n'
+            '{pad}}}').format(pad=pad, name=name, url=upstream)
+
+
+def make_manifest(sdk_dir, size, upstream):
+    """Writes a manifest with @size modules. Returns the names of the modules
+    in build order."""
+    os.makedirs(os.path.join(sdk_dir, 'modules'))
+    entries = []
+    names = []
+    for ix in range(size):
+        name = 'module{}'.format(ix)
+        if ix % INCLUDE_EVERY:
+            entries.append(module_json(name, upstream, 8))
+            names.append(name)
+            continue
+
+        nested = name + '-nested'
+        include = os.path.join('modules', name + '.json')
+        with open(os.path.join(sdk_dir, include), 'w') as f:
+            f.write('// Included module\n' +
+                    module_json(name, upstream, 0)[:-2] +
+                    ',\n    "modules": [\n' +
+                    module_json(nested, upstream, 8) + '\n    ]\n}\n')
+        entries.append('        "{}"'.format(include))
+        names += [nested, name]
+
+    with open(os.path.join(sdk_dir, SDK_ID + '.json.in'), 'w') as f:
+        f.write('/* Synthetic manifest for benchmarking */\n{\n'
+                '    "id": "' + SDK_ID + '",\n'
+                '    "runtime": "org.freedesktop.Platform",\n'
+                '    "sdk": "org.freedesktop.Sdk",\n'
+                '    "build-options": {"cflags": "-O2 -g"},\n'
+                '    "modules": [\n' + ',\n'.join(entries) + '\n    ]\n}\n')
+    return names
+
+
+def make_tree(top, size, latency):
+    """Sets up a workdir and the environment to run flapjack in. Returns the
+    environment and the names of the modules to open."""
+    bindir = os.path.join(top, 'bin')
+    workdir = os.path.join(top, 'work')
+    upstream = os.path.join(top, 'upstream')
+    sdk_dir = os.path.join(workdir, 'checkout', 'gnome-sdk-images')
+
+    write_fakes(bindir)
+    make_upstream(upstream)
+    names = make_manifest(sdk_dir, size, upstream)
+    opened = names[:OPEN_MODULES]
+
+    installed = os.path.join(top, 'installed.txt')
+    with open(installed, 'w') as f:
+        for ref in (SDK_ID, SDK_ID + '.Debug', DEV_SDK_ID,
+                    DEV_SDK_ID + '.Debug'):
+            f.write('{}/x86_64/master\t{}\n'.format(ref, COMMIT[:12]))
+
+    config_file = os.path.join(top, 'flapjack.ini')
+    with open(config_file, 'w') as f:
+        f.write('[Common]\n'
+                'workdir = {}\n'
+                'modules = {}\n'
+                'add_extensions =\n'.format(workdir, ' '.join(opened)))
+
+    env = dict(os.environ,
+               PATH=bindir + os.pathsep + os.environ['PATH'],
+               PYTHONPATH=toplevel,
+               FLAPJACK_CONFIG=config_file,
+               FAKE_LOG=os.path.join(top, 'calls.log'),
+               FAKE_LATENCY=str(latency),
+               FAKE_INSTALLED=installed,
+               REAL_GIT=shutil.which('git'),
+               GIT_AUTHOR_NAME='Benchmark',
+               GIT_AUTHOR_EMAIL='b@localhost',
+               GIT_COMMITTER_NAME='Benchmark',
+               GIT_COMMITTER_EMAIL='b@localhost')
+    return env, opened
+
+
+def count_calls(env):
+    try:
+        with open(env['FAKE_LOG']) as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+
+def timed(env, argv):
+    """Runs a Python snippet or a flapjack command line (a list), and returns
+    the wall time and the number of processes it spawned."""
+    if isinstance(argv, str):
+        cmdline = [sys.executable, '-c', argv]
+    else:
+        cmdline = ([sys.executable, '-c',
+                    'from flapjack.main import main; main()'] + argv)
+
+    calls = count_calls(env)
+    start = time.monotonic()
+    result = subprocess.run(cmdline, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    elapsed = time.monotonic() - start
+    if result.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(
+            ' '.join(argv) if isinstance(argv, list) else 'snippet',
+            result.stderr.decode(errors='replace')))
+    return elapsed, count_calls(env) - calls
+
+
+GENERATE_MANIFEST = 'from flapjack import ext; ext._generate_manifest()'
+
+
+def benchmark(size, latency):
+    """Yields (label, wall time, processes) for each step."""
+    with tempfile.TemporaryDirectory(prefix='flapjack-benchmark.') as top:
+        env, opened = make_tree(top, size, latency)
+        workdir = os.path.join(top, 'work')
+        cache = os.path.join(workdir, 'manifest-cache.dat')
+
+        yield ('list',) + timed(env, ['list'])
+        for module in opened:
+            yield ('open ' + module,) + timed(env, ['open', module])
+
+        os.unlink(cache)
+        yield ('generate manifest (cold)',) + timed(env, GENERATE_MANIFEST)
+        yield ('generate manifest (warm)',) + timed(env, GENERATE_MANIFEST)
+
+        yield ('plan',) + timed(env, ['plan'])
+        yield ('build',) + timed(env, ['build'])
+        yield ('build (no changes)',) + timed(env, ['build'])
+
+        with open(os.path.join(workdir, 'checkout', opened[0], 'main.c'),
+                  'a') as f:
+            f.write('/* changed */\n')
+        yield ('build (one change)',) + timed(env, ['build'])
+
+        yield ('test ' + opened[0],) + timed(env, ['test', opened[0]])
+        yield ('update',) + timed(env, ['update'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the overhead of flapjack commands')
+    parser.add_argument('--sizes', default='10,100,500,2000',
+                        help='Comma-separated numbers of modules in the '
+                             'synthetic manifests (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds that each stand-in executable takes '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    print('{:>7}  {:28}  {:>9}  {:>9}'.format(
+        'Modules', 'Step', 'Wall time', 'Processes'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for label, elapsed, processes in benchmark(size, args.latency):
+            print('{:7}  {:28}  {:7.3f} s  {:9}'.format(
+                size, label, elapsed, processes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import collections
+import hashlib
+import json
+import os
+import os.path
+import shlex
+import shutil
+
+from . import config
+
+"""Flapjack keeps a cache of the files that each open module installs, keyed
+by everything that goes into building the module: its git tree, its effective
+definition in the generated manifest (including build-options), the modules
+built before it, and the commit of the base SDK. When an open module is built
+with inputs that are already in the cache, it is replaced in the manifest by a
+module that unpacks the cached files instead of compiling. The cache is kept
+under artifact_cache_size, evicting the least recently used entries first.
+
+Since flatpak-builder has no way to tell which files a module installed, a
+module whose inputs aren't cached yet is preceded by a small module that
+touches a stamp file, and gets an extra post-install command that archives
+everything in /usr changed after the stamp. If flatpak-builder restored the
+stamp module from its own cache, the stamp file isn't there, and the module's
+files aren't captured in that build."""
+
+
+def enabled():
+    return config.artifact_cache_size() > 0
+
+
+def _cache_dir():
+    return config.artifact_cache_dir()
+
+
+def _stamp_dir():
+    return os.path.join(_cache_dir(), 'stamps')
+
+
+def _archive(key):
+    return os.path.join(_cache_dir(), key + '.tar')
+
+
+def _key(inputs):
+    serialized = json.dumps(inputs, sort_keys=True).encode()
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def _restore_module(module, archive):
+    restored = collections.OrderedDict([
+        ('name', module['name']),
+        ('buildsystem', 'simple'),
+        ('sources', [{'type': 'file', 'path': archive}]),
+        ('build-commands', [
+            'tar -xf {} -C /'.format(shlex.quote(os.path.basename(archive))),
+        ]),
+    ])
+    if 'cleanup' in module:
+        restored['cleanup'] = module['cleanup']
+    return restored
+
+
+def _stamp_module(module, stamp):
+    return collections.OrderedDict([
+        ('name', 'flapjack-stamp-' + module['name']),
+        ('buildsystem', 'simple'),
+        ('build-commands', ['touch ' + shlex.quote(stamp)]),
+        ('build-options', {
+            'build-args': ['--filesystem=' + _cache_dir()],
+        }),
+    ])
+
+
+def _capture_command(stamp, archive):
+    stamp = shlex.quote(stamp)
+    tmpname = shlex.quote(archive + '.tmp')
+    return ('if [ -e {} ]; then cd / && find usr -cnewer {} ! -type d '
+            '-print0 | tar --null -T - -cf {} && mv {} {}; fi'.format(
+                stamp, stamp, tmpname, tmpname, shlex.quote(archive)))
+
+
+def apply(manifest, trees, sdk_commit):
+    """Rewrites the open modules in the generated @manifest to use the cache.
+    @trees maps the names of the open modules to their git tree IDs. Modules
+    found in the cache are replaced by a module that unpacks the cached files,
+    and the others are set up to add their files to the cache."""
+
+    os.makedirs(_stamp_dir(), exist_ok=True)
+
+    inputs = [sdk_commit, manifest.get('build-options', {})]
+    modules = []
+    for module in manifest['modules']:
+        if not isinstance(module, dict) or module['name'] not in trees:
+            inputs.append(module)  # dev tools
+            modules.append(module)
+            continue
+
+        definition = {k: v for k, v in module.items() if k != 'sources'}
+        key = _key(inputs + [trees[module['name']], definition])
+        inputs.append(key)
+        archive = _archive(key)
+
+        if os.path.exists(archive):
+            os.utime(archive)  # mark as recently used
+            modules.append(_restore_module(module, archive))
+            continue
+
+        stamp = os.path.join(_stamp_dir(), key)
+        modules.append(_stamp_module(module, stamp))
+        build_options = module.setdefault('build-options', {})
+        build_options['build-args'] = (build_options.get('build-args', []) +
+                                       ['--filesystem=' + _cache_dir()])
+        module['post-install'] = (module.get('post-install', []) +
+                                  [_capture_command(stamp, archive)])
+        modules.append(module)
+
+    manifest['modules'] = modules
+
+
+def _entries():
+    """Returns a list of (mtime, size, path) of all cached archives."""
+    entries = []
+    for name in os.listdir(_cache_dir()):
+        if not name.endswith('.tar'):
+            continue
+        path = os.path.join(_cache_dir(), name)
+        info = os.stat(path)
+        entries.append((info.st_mtime, info.st_size, path))
+    return entries
+
+
+def finish():
+    """Cleans up after a build, and evicts the least recently used archives
+    until the cache fits in artifact_cache_size."""
+
+    shutil.rmtree(_stamp_dir(), ignore_errors=True)
+    for name in os.listdir(_cache_dir()):
+        if name.endswith('.tar.tmp'):
+            os.unlink(os.path.join(_cache_dir(), name))
+
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= config.artifact_cache_size():
+            break
+        os.unlink(path)
+        total -= size
@@ -0,0 +1,76 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import concurrent.futures
+import json
+import os.path
+import time
+
+from . import config, ext
+
+"""Flapjack keeps a catalog of the runtimes available in each configured
+flatpak remote, since listing the contents of a remote means downloading its
+summary. The catalog is stored in the workdir, and each remote's entry expires
+after the number of hours given by the remote_catalog_ttl config key."""
+
+
+def _catalog_file():
+    return os.path.join(config.workdir(), 'remote-catalog.json')
+
+
+def _read_catalog():
+    try:
+        with open(_catalog_file()) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_catalog(catalog):
+    tmpname = _catalog_file() + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(catalog, f)
+    os.replace(tmpname, _catalog_file())
+
+
+def _list_remote(remote):
+    output = ext.flatpak('remote-ls', remote, '--runtime', '--columns=ref',
+                         output=True)
+    refs = []
+    for line in output.splitlines():
+        ref = line.strip()
+        # Older flatpak versions print full refs, including "runtime/"
+        if ref.startswith('runtime/'):
+            ref = ref[len('runtime/'):]
+        if ref.count('/') == 2:
+            refs.append(ref)
+    return refs
+
+
+def configured_remotes():
+    """Returns a list of (name, options) tuples for the configured remotes, in
+    the order that flatpak lists them."""
+    remotes_list = ext.flatpak('remotes', output=True).split('\n')[1:-1]
+    return [tuple(line.split(maxsplit=1)) for line in remotes_list if line]
+
+
+def runtime_refs(remotes, refresh=False):
+    """Returns a dict mapping each of @remotes (names of flatpak remotes) to
+    the list of runtime refs (ID/arch/branch) available in it. Remotes whose
+    cached entry is missing or expired, or all of them if @refresh is True,
+    are queried in parallel and the cache is updated."""
+
+    cached = _read_catalog()
+    max_age = config.remote_catalog_ttl() * 3600
+    now = time.time()
+    stale = [r for r in remotes
+             if refresh or r not in cached or
+             now - cached[r]['fetched'] > max_age]
+
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(len(stale)) as pool:
+            results = pool.map(_list_remote, stale)
+            for remote, refs in zip(stale, results):
+                cached[remote] = {'fetched': now, 'refs': refs}
+        _write_catalog(cached)
+
+    return {remote: cached[remote]['refs'] for remote in remotes}
@@ -0,0 +1,93 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import collections
+import os
+import os.path
+import shutil
+
+from . import config
+
+"""Support for building with ccache. flatpak-builder keeps its ccache data in
+its own cache directory, which flapjack replaces with a symlink to the
+ccache_dir config key, so that the ccache data can be shared between workdirs
+and survives "flapjack clean-cache".
+
+Each open module gets ccache's stats log (CCACHE_STATSLOG, supported since
+ccache 4.0) pointed at a file of its own, so that hit rates can be shown per
+module."""
+
+# Where flatpak-builder mounts the ccache directory inside the build sandbox
+_SANDBOX_DIR = '/run/ccache'
+_STATS_SUBDIR = 'flapjack-stats'
+
+_HITS = ('direct_cache_hit', 'preprocessed_cache_hit')
+_MISSES = ('cache_miss',)
+
+
+def _stats_file(module):
+    return os.path.join(config.ccache_dir(), _STATS_SUBDIR, module + '.log')
+
+
+def setup():
+    """Makes flatpak-builder's ccache directory point to ccache_dir."""
+    os.makedirs(os.path.join(config.ccache_dir(), _STATS_SUBDIR),
+                exist_ok=True)
+
+    link = os.path.join(config.builder_cache(), 'ccache')
+    if os.path.islink(link):
+        if os.readlink(link) == config.ccache_dir():
+            return
+        os.unlink(link)
+    elif os.path.isdir(link):
+        shutil.rmtree(link)
+    os.makedirs(config.builder_cache(), exist_ok=True)
+    os.symlink(config.ccache_dir(), link)
+
+
+def stats_env(module):
+    """Environment variables for @module's build, so that its ccache
+    statistics are logged to its own file."""
+    return {
+        'CCACHE_STATSLOG': '/'.join((_SANDBOX_DIR, _STATS_SUBDIR,
+                                     module + '.log')),
+    }
+
+
+def _classify(counters):
+    if any(counter in _HITS for counter in counters):
+        return 'hits'
+    if any(counter in _MISSES for counter in counters):
+        return 'misses'
+    return 'other'
+
+
+def read_stats(module):
+    """Returns a Counter with the number of 'hits', 'misses', and 'other'
+    results (such as uncacheable calls) for compilations in @module since its
+    statistics were last reset."""
+    counts = collections.Counter()
+    try:
+        with open(_stats_file(module)) as f:
+            # Each compilation is a "# <input file>" line followed by the
+            # names of the counters that it incremented
+            counters = None
+            for line in f:
+                line = line.strip()
+                if line.startswith('#'):
+                    if counters is not None:
+                        counts[_classify(counters)] += 1
+                    counters = []
+                elif line and counters is not None:
+                    counters.append(line)
+            if counters is not None:
+                counts[_classify(counters)] += 1
+    except FileNotFoundError:
+        pass
+    return counts
+
+
+def reset_stats(module):
+    try:
+        os.unlink(_stats_file(module))
+    except FileNotFoundError:
+        pass
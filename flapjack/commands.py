@@ -1,21 +1,25 @@
 # Copyright 2017 Endless Mobile, Inc.
 
 import argparse
-import operator
+import collections
+import concurrent.futures
+import errno
 import os
 import os.path
 import shutil
+import statistics
 import subprocess
 import sys
+import time
 
-from . import config, ext, state, util
+from . import (catalog, ccache, config, ext, history, inotify, prune,
+               registry, state, trace, util)
 
 """Module that contains the base class for flapjack CLI subcommands, the
 mechanism for registering them, and the built-in subcommands. (If subcommands
 get more complicated, consider putting them in their own module.)"""
 
 _command_registry = {}
-_REPO = os.path.join(config.workdir(), 'repo')
 
 _NON_GIT_SOURCE_MESSAGE = """
 Only sources of type "git" are currently supported. You can override this
@@ -24,6 +28,10 @@ module with a git repository by setting a key in your config file:
 url = ...
 """
 
+# How many builds and modules "flapjack stats build" shows
+_RECENT_BUILDS = 10
+_SLOWEST_MODULES = 10
+
 
 def set_verbose(level):
     ext.verbose_level = level
@@ -31,7 +39,9 @@ def set_verbose(level):
 
 def register_command(name):
     """Decorator for use with command classes, makes the command available to
-    flapjack's CLI and help text."""
+    flapjack's CLI. The command must also be described in the registry
+    module, which is where the help text comes from; devscripts/
+    bashcompletion.py checks that the two descriptions match."""
 
     def decorator(klass):
         klass.NAME = name
@@ -45,40 +55,10 @@ def get_command(name):
     return _command_registry[name]()
 
 
-def get_all_commands():
-    """Get all commands grouped by their parameter requirements."""
-    commands = {
-        'all': _command_registry.keys(),
-        'requiring module': [],
-        'requiring app': [],
-        'no params': [],
-    }
-    for name in commands['all']:
-        command = get_command(name)
-        action_dests = []
-        for action in command.parser._actions:
-            action_dests.append(action.dest)
-
-        if 'module' in action_dests:
-            commands['requiring module'].append(name)
-        elif 'app' in action_dests:
-            commands['requiring app'].append(name)
-        else:
-            commands['no params'].append(name)
-
-    return commands
-
-
-def get_help_text():
-    """One line of each command name and description."""
-    retval = ''
-    for cmd, klass in sorted(list(_command_registry.items()),
-                             key=operator.itemgetter(0)):
-        retval += '  {:12} {}\n'.format(cmd, klass.__doc__)
-    return retval
-
-
 class Command:
+    # Set to True in commands that need the local ostree repo to exist
+    REQUIRES_REPO = False
+
     def __init__(self):
         self.parser = argparse.ArgumentParser(
             prog='{} {}'.format(os.path.basename(sys.argv[0]), self.NAME),
@@ -88,95 +68,244 @@ class Command:
         # Setup tasks that are inexpensive enough to do on every startup
         # instead of as part of "flapjack setup"
         os.makedirs(config.checkoutdir(), exist_ok=True)
-        os.makedirs(_REPO, exist_ok=True)
 
-        subprocess.check_call(['ostree', 'init', '--repo', _REPO,
-                               '--mode=bare-user'])
+        # The repo's config file is the last thing "ostree init" writes, so
+        # if it's there, the repo was already initialized
+        if (self.REQUIRES_REPO and
+                not os.path.exists(os.path.join(config.repo(), 'config'))):
+            os.makedirs(config.repo(), exist_ok=True)
+            ext.ostree('init', '--repo', config.repo(), '--mode=bare-user')
 
     def run(self, argv):
         args = self.parser.parse_args(argv)
-        self._quick_setup()
-        return self.execute(args)
+        with trace.span('flapjack ' + self.NAME, 'command', argv=argv):
+            self._quick_setup()
+            return self.execute(args)
 
     def execute(self, args):
         raise NotImplementedError
 
 
-def find_remote_for_runtime(runtime, branch):
-    """Search for the runtime in all configured remotes. Expensive check."""
-    remotes_list = ext.flatpak('remotes', output=True).split('\n')[1:-1]
-    remotes = [line.split(maxsplit=1) for line in remotes_list if line]
-    for candidate_remote in remotes:
-        candidate_remote_name = candidate_remote[0]
-        runtimes_list = ext.flatpak('remote-ls', candidate_remote_name,
-                                    '--runtime', '--columns=ref', output=True)
-        runtimes_list = runtimes_list.split('\n')[1:]
-        for quad in runtimes_list:
-            if not quad:
-                continue
-            candidate_id, _, candidate_branch = quad.split('/')[1:]
-            if candidate_id == runtime and candidate_branch == branch:
-                return candidate_remote
+def find_remote_for_runtime(runtime, branch, refresh=False):
+    """Search for the runtime in all configured remotes. Expensive check if
+    the remote catalog cache is cold, if @refresh is given, or if the runtime
+    isn't in the cached catalog, since the cache may be out of date."""
+    remotes = catalog.configured_remotes()
+    for refresh in sorted({refresh, True}):
+        refs = catalog.runtime_refs([remote[0] for remote in remotes],
+                                    refresh)
+        for candidate_remote in remotes:
+            for ref in refs[candidate_remote[0]]:
+                candidate_id, _, candidate_branch = ref.split('/')
+                if candidate_id == runtime and candidate_branch == branch:
+                    return candidate_remote
 
     raise RuntimeError('{} not found in any remotes: I checked {}'.format(
-        runtime, ', '.join(remotes)))
-
-
-def ensure_runtime(remote, runtime, branch, subpaths=False):
-    if ext.flatpak('info', '--show-commit', runtime, branch, code=True) != 0:
-        if remote is None:
-            remote_name, remote_type = find_remote_for_runtime(runtime, branch)
-            # Don't assume yes here, since Flapjack picked an arbitrary remote
-            ext.flatpak('install', '--{}'.format(remote_type), remote_name,
-                        runtime, branch)
-        else:
-            ext.flatpak('install', '--assumeyes', remote, runtime, branch)
-    if subpaths:
-        ext.flatpak('update', '--assumeyes', '--subpath=', runtime, branch)
-    else:
-        ext.flatpak('update', '--assumeyes', runtime, branch)
+        runtime, ', '.join(remote[0] for remote in remotes)))
+
+
+def _refs(runtimes):
+    return ['{}//{}'.format(runtime, branch) for runtime, branch in runtimes]
+
+
+def ensure_runtimes(remote, runtimes, subpaths=(), refresh_remotes=False):
+    """Makes sure that all of @runtimes, a list of (ID, branch) tuples, are
+    installed and up to date. Runtimes that are missing are installed from
+    @remote in one flatpak transaction, and the rest are updated in another.
+    If @remote is None, the missing runtimes are looked up in all configured
+    remotes, refreshing the remote catalog first if @refresh_remotes is True.
+    Runtimes whose IDs are listed in @subpaths are updated with all
+    their subpaths."""
+
+    with trace.span('install runtimes', 'phase', runtimes=_refs(runtimes)):
+        missing = [r for r in runtimes if r not in ext.installed_runtimes()]
+        if missing:
+            if remote is None:
+                by_remote = collections.OrderedDict()
+                for runtime, branch in missing:
+                    found = find_remote_for_runtime(runtime, branch,
+                                                    refresh_remotes)
+                    refresh_remotes = False  # once is enough
+                    by_remote.setdefault(found, []).append(
+                        (runtime, branch))
+                for (remote_name, remote_type), group in by_remote.items():
+                    # Don't assume yes here, since Flapjack picked an arbitrary
+                    # remote
+                    ext.flatpak('install', '--{}'.format(remote_type),
+                                remote_name, *_refs(group))
+            else:
+                ext.flatpak('install', '--assumeyes', remote, *_refs(missing))
+            ext.installed_runtimes.cache_clear()
+
+        # Freshly installed runtimes don't need updating, except to pull in all
+        # of their subpaths
+        outdated = [r for r in runtimes
+                    if r not in missing and r[0] not in subpaths]
+        if outdated:
+            ext.flatpak('update', '--assumeyes', *_refs(outdated))
+        with_subpaths = [r for r in runtimes if r[0] in subpaths]
+        if with_subpaths:
+            ext.flatpak('update', '--assumeyes', '--subpath=',
+                        *_refs(with_subpaths))
+        if outdated or with_subpaths:
+            ext.installed_runtimes.cache_clear()
 
 
 def ensure_base_sdk():
     ext.flatpak('remote-add', '--if-not-exists', '--from',
                 config.sdk_repo_name(), config.sdk_repo_definition())
-    ensure_runtime(config.sdk_repo_name(), config.sdk_id(),
-                   config.sdk_branch())
-    ensure_runtime(config.sdk_repo_name(), config.sdk_id() + '.Debug',
-                   config.sdk_branch())
-    ensure_runtime(config.sdk_repo_name(), config.sdk_id() + '.Locale',
-                   config.sdk_branch(), subpaths=True)
+    sdk_id = config.sdk_id()
+    sdk_branch = config.sdk_branch()
+    ensure_runtimes(config.sdk_repo_name(), [
+        (sdk_id, sdk_branch),
+        (sdk_id + '.Debug', sdk_branch),
+        (sdk_id + '.Locale', sdk_branch),
+    ], subpaths=[sdk_id + '.Locale'])
 
 
 def ensure_dev_sdk():
+    """Installs the dev SDK and its debug extension from the local repo, or
+    updates them, unless the repo's commits are already the active ones."""
+    runtimes = [
+        (config.dev_sdk_id(), 'master'),
+        (config.dev_sdk_id() + '.Debug', 'master'),
+    ]
+    outdated = []
+    for runtime, branch in runtimes:
+        commit = ext.repo_commit(runtime, branch)
+        # flatpak may show the active commit shortened
+        active = ext.installed_runtimes().get((runtime, branch))
+        if commit is None or not active or not commit.startswith(active):
+            outdated.append((runtime, branch))
+    if not outdated:
+        return
+
     ext.flatpak('remote-add', '--if-not-exists', '--no-gpg-verify', 'flapjack',
-                _REPO)
-    ensure_runtime('flapjack', config.dev_sdk_id(), 'master')
-    ensure_runtime('flapjack', config.dev_sdk_id() + '.Debug', 'master')
+                config.repo())
+    ext.flatpak('build-update-repo', '--generate-static-deltas',
+                config.repo())
+    ensure_runtimes('flapjack', outdated)
 
 
-def ensure_add_extensions():
+def ensure_add_extensions(refresh_remotes=False):
     """Examines the add_extensions config key, and the manifest's add-extensions
     key, and attempts to install any extensions mentioned there. Looks through
     all the configured remotes."""
+    extensions = []
     for add_extension in config.add_extensions():
         ext_id = add_extension.split(':', 1)[0]
         branch = None
         if '/' in ext_id:
             ext_id, _, branch = ext_id.split('/', 2)
-        ensure_runtime(None, ext_id, 'master' if branch is None else branch)
+        extensions.append((ext_id, 'master' if branch is None else branch))
+    ensure_runtimes(None, extensions, refresh_remotes=refresh_remotes)
+
+
+def build_dev_sdk():
+    """Builds the dev SDK into the local repo and installs it, unless nothing
+    changed since the last build. Returns flatpak-builder's exit code if the
+    build failed."""
+    previous_commit = ext.repo_commit(config.dev_sdk_id(), 'master')
+    exitcode = ext.flatpak_builder('--require-changes', '--repo',
+                                   config.repo(), skip_unchanged=True)
+    if exitcode is None:
+        ensure_dev_sdk()
+        return 0
+    if exitcode != 0:
+        return exitcode
+
+    ensure_dev_sdk()
+
+    # With --require-changes, the build may not have exported anything new
+    commit = ext.repo_commit(config.dev_sdk_id(), 'master')
+    if config.repo_keep_commits() > 0 and commit != previous_commit:
+        prune.prune_repo(config.repo_keep_commits())
+
+    budget = config.builder_cache_size()
+    size = budget and prune.disk_usage(config.builder_cache())
+    if budget and size > budget:
+        freed = prune.prune_builder_cache(max_size=budget, only_if_fits=True)
+        if freed:
+            print('Trimmed the flatpak-builder cache by {}'.format(
+                util.format_size(freed)))
+        if size - freed > budget:
+            print('The flatpak-builder cache is still bigger than '
+                  'builder_cache_size, since the current build needs it')
+
+
+def _run_args(app, options):
+    """Arguments for "flatpak" to run @app against the dev SDK."""
+    return (['run', '--devel'] + config.shell_permissions() +
+            ['--runtime={}//master'.format(config.dev_sdk_id()), app] +
+            options)
+
+
+# Keys in the [Context] group of an app's metadata, and the "flatpak build"
+# options that grant and revoke them
+_CONTEXT_OPTIONS = collections.OrderedDict([
+    ('shared', ('--share', '--unshare')),
+    ('sockets', ('--socket', '--nosocket')),
+    ('devices', ('--device', '--nodevice')),
+    ('features', ('--allow', '--disallow')),
+    ('filesystems', ('--filesystem', '--nofilesystem')),
+    ('persistent', ('--persist', None)),
+])
+
+
+def _context_args(metadata):
+    """Translates the permissions in an app's @metadata into options for
+    "flatpak build", which doesn't apply them by itself."""
+    args = []
+    for key, (grant, revoke) in _CONTEXT_OPTIONS.items():
+        values = metadata.get('Context', key, fallback='')
+        for value in filter(None, values.split(';')):
+            if not value.startswith('!'):
+                args.append('{}={}'.format(grant, value))
+            elif revoke is not None:
+                args.append('{}={}'.format(revoke, value[1:]))
+
+    for section, prefix in (('Session Bus Policy', '--'),
+                            ('System Bus Policy', '--system-')):
+        if not metadata.has_section(section):
+            continue
+        for name, policy in metadata.items(section):
+            if policy in ('talk', 'own'):
+                args.append('{}{}-name={}'.format(prefix, policy, name))
+
+    if metadata.has_section('Environment'):
+        args += ['--env={}={}'.format(key, value)
+                 for key, value in metadata.items('Environment')]
+    return args
+
+
+def _build_run_args(app, options):
+    """Arguments for "flatpak" to run @app against the runtime in the build
+    directory, as flatpak-builder left it, without exporting or installing
+    it. The installed app is mounted on /app. Raises RuntimeError if the
+    app isn't installed, or doesn't say which command to run."""
+    try:
+        location, metadata = ext.app_info(app)
+    except subprocess.CalledProcessError:
+        raise RuntimeError('{} is not installed. Install it with "flatpak '
+                           'install" first.'.format(app))
+    command = metadata.get('Application', 'command', fallback=None)
+    if command is None:
+        raise RuntimeError("{}'s metadata doesn't say which command to "
+                           'run'.format(app))
+    return (['build',
+             '--bind-mount=/app={}'.format(os.path.join(location, 'files'))] +
+            _context_args(metadata) + config.shell_permissions() +
+            [config.build_dir(), command] + options)
 
 
 @register_command('build')
 class Build(Command):
     """Build a development flatpak runtime"""
 
-    def execute(self, args):
-        exitcode = ext.flatpak_builder('--require-changes', '--repo', _REPO)
-        if exitcode != 0:
-            return exitcode
+    REQUIRES_REPO = True
 
-        ensure_dev_sdk()
+    def execute(self, args):
+        return build_dev_sdk()
 
 
 @register_command('close')
@@ -193,6 +322,47 @@ class Close(Command):
         state.set_open_modules(currently_open)
 
 
+@register_command('gc')
+class GC(Command):
+    """Free disk space used by old builds"""
+
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('--max-size', type=config.parse_size,
+                                 metavar='SIZE',
+                                 help='Trim the flatpak-builder cache until '
+                                      'it is no bigger than this (default: '
+                                      'builder_cache_size)')
+        self.parser.add_argument('--older-than', type=prune.parse_age,
+                                 metavar='AGE',
+                                 help='Remove the parts of the '
+                                      'flatpak-builder cache not used for '
+                                      'this long')
+
+    def execute(self, args):
+        freed = collections.OrderedDict()
+
+        before = prune.disk_usage(config.repo())
+        if os.path.exists(os.path.join(config.repo(), 'config')):
+            prune.prune_repo(config.repo_keep_commits())
+        freed['Repository'] = before - prune.disk_usage(config.repo())
+
+        freed['Build directory'] = prune.remove_build_dirs()
+
+        max_size = args.max_size
+        if max_size is None:
+            max_size = config.builder_cache_size() or None
+        freed['flatpak-builder cache'] = prune.prune_builder_cache(
+            max_size=max_size, older_than=args.older_than)
+
+        width = max(len(what) for what in freed)
+        for what, size in freed.items():
+            print('  {:{width}}  {:>10}'.format(
+                what, util.format_size(size), width=width))
+        print('  {:{width}}  {:>10}'.format(
+            'Total', util.format_size(sum(freed.values())), width=width))
+
+
 @register_command('list')
 class List(Command):
     """List the modules available for development"""
@@ -216,9 +386,12 @@ class Open(Command):
         if args.module in currently_open:
             return
 
-        source_manifest = util.get_source_manifest()
-        module = next(m for m in source_manifest['modules']
-                      if m['name'] == args.module)
+        try:
+            _, module = util.get_module_index()[args.module]
+        except KeyError:
+            print('Module {} is not in the manifest {}'.format(
+                args.module, config.source_manifest()))
+            return 1
 
         git_clone = os.path.join(config.checkoutdir(), args.module)
         if not os.path.exists(git_clone):
@@ -243,29 +416,106 @@ class Open(Command):
         state.set_open_modules(currently_open)
 
 
+@register_command('plan')
+class Plan(Command):
+    """Show which modules the next build will rebuild"""
+
+    @staticmethod
+    def _invalidation(current, last):
+        """Returns the index of the first module in @current that
+        flatpak-builder will have to build again, and the reason why. The
+        index is len(current['modules']) if the build will only redo the
+        stages after the modules, and None if nothing changed."""
+        if not isinstance(last, dict):
+            return 0, 'no build has been recorded yet'
+        if current['sdk'] != last['sdk']:
+            return 0, 'the base SDK changed'
+        if current['global'] != last['global']:
+            return 0, 'the manifest changed'
+
+        for ix, (name, definition, commit) in enumerate(current['modules']):
+            try:
+                last_name, last_definition, last_commit = last['modules'][ix]
+            except IndexError:
+                return ix, 'it is new'
+            if name != last_name:
+                return ix, 'the module order changed'
+            if commit != last_commit:
+                return ix, 'its sources changed'
+            if definition != last_definition:
+                return ix, 'its definition changed'
+        if len(last['modules']) > len(current['modules']):
+            return len(current['modules']), 'a module was removed'
+        if current != last:
+            return len(current['modules']), 'the manifest changed'
+        return None, None
+
+    def execute(self, args):
+        current = ext.build_inputs()
+        modules = current['modules']
+        last = state.get_last_build()
+        first, reason = self._invalidation(current, last)
+
+        for ix, (name, _, _) in enumerate(modules):
+            rebuild = first is not None and ix >= first
+            print(' {:7} {}'.format('rebuild' if rebuild else 'cached', name))
+
+        # The same test that "flapjack build" uses to skip the build
+        if current == last:
+            print('Nothing to do, the runtime is up to date')
+        elif first >= len(modules):
+            print('No modules will be rebuilt, but the runtime will be '
+                  'exported again because {}'.format(reason))
+        else:
+            print('{} of {} modules will be rebuilt, starting at {} because '
+                  '{}'.format(len(modules) - first, len(modules),
+                              modules[first][0], reason))
+
+
 @register_command('run')
 class Run(Command):
     """Run an app against the development runtime"""
 
     def __init__(self):
         super().__init__()
+        self.parser.add_argument('--from-build', action='store_true',
+                                 help='Build the runtime without exporting or '
+                                      'installing it, and run the app '
+                                      'against the build directory')
         self.parser.add_argument('app', help='ID of app to run')
         self.parser.add_argument('options', nargs=argparse.REMAINDER,
                                  help='Command-line options to pass to app')
 
     def execute(self, args):
-        opts = (['run', '--devel'] + config.shell_permissions() +
-                ['--runtime={}//master'.format(config.dev_sdk_id()),
-                 args.app] +
-                args.options)
-        ext.flatpak(*opts, code=True)
-        # COMPAT: unpacking two lists supported in py3.5
+        if not args.from_build:
+            return ext.flatpak(*_run_args(args.app, args.options), code=True)
+
+        # Look the app up first, so as not to build for nothing
+        try:
+            run_args = _build_run_args(args.app, args.options)
+        except RuntimeError as e:
+            print(e)
+            return 1
+
+        exitcode = ext.flatpak_builder()
+        if exitcode != 0:
+            return exitcode
+        return ext.flatpak(*run_args, code=True)
 
 
 @register_command('setup')
 class Setup(Command):
     """Get set up to use flapjack for the first time"""
 
+    REQUIRES_REPO = True
+
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('--refresh-remotes', action='store_true',
+                                 help='Query all flatpak remotes again '
+                                      'instead of using the cached list of '
+                                      'what they contain')
+
     def execute(self, args):
         if not os.path.exists(config.upstream_sdk_checkout()):
             ext.git(config.checkoutdir(), 'clone', '--branch',
@@ -275,13 +525,20 @@ class Setup(Command):
                     config.sdk_upstream_branch())
 
         ensure_base_sdk()
-        ensure_add_extensions()
+        ensure_add_extensions(args.refresh_remotes)
 
 
 @register_command('shell')
 class Shell(Command):
     """Open a shell in the development runtime's sandbox"""
 
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('--from-build', action='store_true',
+                                 help='Build the runtime without exporting or '
+                                      'installing it, and open the shell in '
+                                      'the build directory')
+
     def execute(self, args):
         env_vars = {
             # This will be used as $PS1 if the users don't have a
@@ -297,6 +554,15 @@ class Shell(Command):
         env_vars_list = list("--env={}={}".format(_key, val)
                              for _key, val in env_vars.items())
 
+        if args.from_build:
+            exitcode = ext.flatpak_builder()
+            if exitcode != 0:
+                return exitcode
+            opts = (['build', '--filesystem={}'.format(config.workdir())] +
+                    config.shell_permissions() + env_vars_list +
+                    [config.build_dir(), 'bash'])
+            return ext.flatpak(*opts, code=True)
+
         opts = (['run', '--devel', '--command=bash',
                  '--filesystem={}'.format(config.workdir())] +
                 config.shell_permissions() + env_vars_list +
@@ -305,6 +571,112 @@ class Shell(Command):
         # COMPAT: unpacking non-final list supported in py3.5
 
 
+@register_command('stats')
+class Stats(Command):
+    """Show statistics about builds and caches"""
+
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('what', choices=registry.COMMANDS['stats'][1],
+                                 help='Which statistics to show')
+        self.parser.add_argument('--reset', action='store_true',
+                                 help='Start counting again from zero')
+
+    @staticmethod
+    def _module_time(entry, module):
+        return sum(entry['modules'][module]['times'].values())
+
+    def _build(self, args):
+        if args.reset:
+            history.clear()
+            return
+
+        entries = history.read()
+        if not entries:
+            print('No builds have been recorded yet.')
+            return
+
+        print('Recent builds:')
+        for entry in entries[-_RECENT_BUILDS:]:
+            modules = entry['modules'].values()
+            built = sum(1 for m in modules if m['cache'] == 'miss')
+            print('  {}  {:5}  {:6}  {:>8}  {} built, {} cached'.format(
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time'])),
+                entry['command'], 'ok' if entry['exitcode'] == 0 else 'failed',
+                util.format_duration(entry['total']), built,
+                len(modules) - built))
+
+        last = entries[-1]
+        print()
+        print('Stages of the last build: ' + ', '.join(
+            '{} {}'.format(stage, util.format_duration(seconds))
+            for stage, seconds in last['stages'].items()))
+
+        built = [name for name, m in last['modules'].items()
+                 if m['cache'] == 'miss']
+        if not built:
+            return
+        built.sort(key=lambda name: self._module_time(last, name),
+                   reverse=True)
+        built = built[:_SLOWEST_MODULES]
+
+        # Compare with the earlier successful builds of each module
+        width = max(len('Module'), *(len(name) for name in built))
+        print()
+        print('  {:{width}}  {:>8}  {:>8}  {:>7}'.format(
+            'Module', 'Time', 'Median', 'Change', width=width))
+        for name in built:
+            seconds = self._module_time(last, name)
+            previous = [self._module_time(e, name) for e in entries[:-1]
+                        if (e['exitcode'] == 0 and
+                            e['modules'].get(name, {}).get('cache') == 'miss')]
+            median = change = '-'
+            if previous:
+                median = statistics.median(previous)
+                if median:
+                    change = '{:+.0%}'.format(seconds / median - 1)
+                median = util.format_duration(median)
+            print('  {:{width}}  {:>8}  {:>8}  {:>7}'.format(
+                name, util.format_duration(seconds), median, change,
+                width=width))
+
+    def _ccache(self, args):
+        modules = state.get_open_modules()
+        if args.reset:
+            for module in modules:
+                ccache.reset_stats(module)
+            return
+
+        if not config.use_ccache():
+            print('ccache is not enabled. Set use_ccache = yes in your '
+                  'config file.')
+        print('ccache directory: {} ({})'.format(
+            config.ccache_dir(),
+            util.format_size(prune.disk_usage(config.ccache_dir()))))
+        if not modules:
+            return
+
+        width = max(len('Module'), *(len(module) for module in modules))
+        print()
+        print('  {:{width}}  {:>6}  {:>6}  {:>6}  {:>8}'.format(
+            'Module', 'Hits', 'Misses', 'Other', 'Hit rate', width=width))
+        for module in modules:
+            counts = ccache.read_stats(module)
+            cacheable = counts['hits'] + counts['misses']
+            rate = '-'
+            if cacheable:
+                rate = '{:.0%}'.format(counts['hits'] / cacheable)
+            print('  {:{width}}  {:6}  {:6}  {:6}  {:>8}'.format(
+                module, counts['hits'], counts['misses'], counts['other'],
+                rate, width=width))
+
+    def execute(self, args):
+        if args.what == 'build':
+            return self._build(args)
+        if args.what == 'ccache':
+            return self._ccache(args)
+
+
 @register_command('test')
 class Test(Command):
     """Build a module and run its tests"""
@@ -338,35 +710,217 @@ class Test(Command):
 class Update(Command):
     """Update your runtimes and git checkouts"""
 
+    def _fetch(self, git_clone):
+        start = time.monotonic()
+        if not ext.git(git_clone, 'remote', output=True):
+            return 'skipped', time.monotonic() - start
+        try:
+            ext.git(git_clone, 'fetch', '--quiet')
+        except subprocess.CalledProcessError:
+            return 'failed', time.monotonic() - start
+        return 'updated', time.monotonic() - start
+
     def execute(self, args):
         ensure_base_sdk()
 
-        there_were_errors = False
-        for entry in os.listdir(config.checkoutdir()):
+        git_clones = []
+        for entry in sorted(os.listdir(config.checkoutdir())):
             git_clone = os.path.join(config.checkoutdir(), entry)
             if not os.path.isdir(git_clone):
                 continue
             if not os.path.exists(os.path.join(git_clone, '.git')):
                 continue
-            if not ext.git(git_clone, 'remote', output=True):
-                continue
+            git_clones.append(entry)
+
+        results = {}
+        jobs = max(1, config.update_jobs())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                pool.submit(self._fetch,
+                            os.path.join(config.checkoutdir(), entry)): entry
+                for entry in git_clones
+            }
+            for future in concurrent.futures.as_completed(futures):
+                entry = futures[future]
+                results[entry] = future.result()
+                result, elapsed = results[entry]
+                if result == 'failed':
+                    print('Error updating {}'.format(entry))
+                else:
+                    print('[{}/{}] {} {} ({:.1f} s)'.format(
+                        len(results), len(git_clones), entry, result,
+                        elapsed))
+
+        if results:
+            width = max(len(entry) for entry in results)
+            print()
+            for entry in git_clones:
+                result, elapsed = results[entry]
+                print('  {:{width}}  {:7}  {:6.1f} s'.format(
+                    entry, result, elapsed, width=width))
+
+        if any(result == 'failed' for result, _ in results.values()):
+            print('Some repositories failed to update.')
+            return 1
+
+
+@register_command('watch')
+class Watch(Command):
+    """Rebuild the development runtime when open modules change"""
+
+    REQUIRES_REPO = True
+
+    # Names of files and directories in checkouts whose changes don't need a
+    # rebuild, in addition to anything that git ignores
+    _IGNORED_NAMES = ('.git', '__pycache__', 'autom4te.cache')
+    _IGNORED_SUFFIXES = ('.o', '.lo', '.la', '.a', '.so', '.pyc', '.swp',
+                         '.swx', '~')
+
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('app', nargs='?',
+                                 help='ID of app to restart after each '
+                                      'successful build')
+        self.parser.add_argument('--debounce', type=float, default=1.0,
+                                 metavar='SECONDS',
+                                 help='Rebuild only after no files have '
+                                      'changed for this long (default 1)')
+        self._watcher = None
+        self._modules = {}
+        self._ignored_dirs = set()
+        self._app = None
+
+    def _ignored(self, name):
+        return (name in self._IGNORED_NAMES or name.startswith('.#') or
+                name.endswith(self._IGNORED_SUFFIXES))
+
+    def _watch_tree(self, top, module):
+        for dirpath, dirnames, _ in os.walk(top):
+            dirnames[:] = [d for d in dirnames
+                           if not self._ignored(d) and
+                           os.path.join(dirpath, d) not in self._ignored_dirs]
             try:
-                ext.git(git_clone, 'fetch')
-            except subprocess.CalledProcessError:
-                print('Error updating {}'.format(entry))
-                there_were_errors = True
+                self._watcher.add_watch(dirpath)
+            except (FileNotFoundError, NotADirectoryError):
+                continue  # removed while we were walking
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                raise RuntimeError(
+                    'Ran out of inotify watches while watching {}. Raise the '
+                    'limit, for example with "sudo sysctl '
+                    'fs.inotify.max_user_watches=524288", and try again.'
+                    .format(module))
+            self._modules[dirpath] = module
+
+    def _watch_module(self, module):
+        git_clone = os.path.join(config.checkoutdir(), module)
+        ignored = ext.git(git_clone, 'ls-files', '--others', '--ignored',
+                          '--exclude-standard', '--directory', output=True)
+        self._ignored_dirs.update(
+            os.path.join(git_clone, line.rstrip('/'))
+            for line in ignored.splitlines() if line.endswith('/'))
+        self._watch_tree(git_clone, module)
+
+    def _changed_modules(self, events):
+        changed = set()
+        for path, name, mask in events:
+            if path is None:  # events were lost, assume everything changed
+                return set(self._modules.values())
+            if self._ignored(name):
+                continue
+            full_path = os.path.join(path, name)
+            if full_path in self._ignored_dirs:
+                continue
+            module = self._modules[path]
+            if mask & inotify.IN_ISDIR and mask & (inotify.IN_CREATE |
+                                                   inotify.IN_MOVED_TO):
+                self._watch_tree(full_path, module)
+            changed.add(module)
+        return changed
+
+    def _wait_for_changes(self, debounce):
+        changed = set()
+        while not changed:
+            changed = self._changed_modules(self._watcher.read())
+        # Keep collecting until things have been quiet for a while, so that a
+        # burst of saves only causes one rebuild
+        while True:
+            events = self._watcher.read(timeout=debounce)
+            if not events:
+                return changed
+            changed |= self._changed_modules(events)
+
+    def _stop_app(self):
+        if self._app is None or self._app.poll() is not None:
+            return
+        self._app.terminate()
+        try:
+            self._app.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._app.kill()
+            self._app.wait()
+
+    def _build(self, app):
+        try:
+            failed = build_dev_sdk()
+        except (RuntimeError, subprocess.CalledProcessError, OSError) as e:
+            print(e)
+            failed = True
+        if failed:
+            print('Build failed. Waiting for more changes...')
+            return
+        if app is not None:
+            self._stop_app()
+            self._app = ext.flatpak(*_run_args(app, []), background=True)
+        print('Build finished. Waiting for changes...')
 
-        if there_were_errors:
-            print('Some repositories failed to update.')
+    def execute(self, args):
+        self._watcher = inotify.Watcher()
+        try:
+            for module in state.get_open_modules():
+                self._watch_module(module)
+
+            self._build(args.app)
+            while True:
+                changed = self._wait_for_changes(args.debounce)
+                print('Changes in {}, rebuilding...'.format(
+                    ', '.join(sorted(changed))))
+                self._build(args.app)
+        except KeyboardInterrupt:
+            return 0
+        except RuntimeError as e:
+            print(e)
             return 1
+        finally:
+            self._stop_app()
+            self._watcher.close()
 
 
 @register_command('clean-cache')
 class CleanCache(Command):
     """Clean the flatpak-builder cache"""
 
+    def __init__(self):
+        super().__init__()
+        self.parser.add_argument('--max-size', type=config.parse_size,
+                                 metavar='SIZE',
+                                 help='Only remove the least recently used '
+                                      'parts of the cache until it is no '
+                                      'bigger than this (e.g. 20G)')
+        self.parser.add_argument('--older-than', type=prune.parse_age,
+                                 metavar='AGE',
+                                 help='Only remove the parts of the cache '
+                                      'not used for this long (e.g. 14d)')
+
     def execute(self, args):
-        cache_dir = os.path.join(config.workdir(), '.flatpak-builder')
+        if args.max_size is not None or args.older_than is not None:
+            freed = prune.prune_builder_cache(max_size=args.max_size,
+                                              older_than=args.older_than)
+            print('Freed {}'.format(util.format_size(freed)))
+            return 0
+
+        cache_dir = config.builder_cache()
         if os.path.isdir(cache_dir):
             shutil.rmtree(cache_dir, ignore_errors=True)
         return 0
@@ -1,6 +1,7 @@
 # Copyright 2017 Endless Mobile, Inc.
 
 import configparser
+import functools
 import os
 import shlex
 
@@ -10,6 +11,14 @@ _DEFAULTS = {
         'checkoutdir': '${workdir}/checkout',
         'shell_prefix': 'flapjack',
         'user_installation': 'no',
+        'update_jobs': '4',
+        'remote_catalog_ttl': '24',
+        'artifact_cache_dir': '${workdir}/artifact-cache',
+        'artifact_cache_size': '0',
+        'builder_cache_size': '0',
+        'repo_keep_commits': '3',
+        'use_ccache': 'no',
+        'ccache_dir': '~/.cache/flapjack/ccache',
 
         'sdk_upstream': 'https://gitlab.gnome.org/GNOME/gnome-sdk-images.git',
         'sdk_upstream_branch': 'master',
@@ -27,30 +36,48 @@ _DEFAULTS = {
     },
 }
 
-_interp = configparser.ExtendedInterpolation()
-_config = configparser.ConfigParser(interpolation=_interp)
-# Default is case-insensitive keys, we need case-sensitive for the environment
-# variable sections
-_config.optionxform = lambda option: option
-_config.read_dict(_DEFAULTS)
 
-
-def _get_config_file():
+def config_file():
+    """Returns the path of the config file in use."""
     if os.environ.get('FLAPJACK_CONFIG'):
         return os.path.expanduser(os.environ['FLAPJACK_CONFIG'])
     return os.path.expanduser('~/.config/flapjack.ini')
 
 
-try:
-    config_file = _get_config_file()
-    with open(config_file) as f:
-        _config.read_file(f, source=config_file)
-except FileNotFoundError:
-    pass  # no config file, use all defaults
+@functools.lru_cache()
+def _load():
+    """Reads the config file the first time a config option is needed, so
+    that importing this module stays cheap."""
+    interp = configparser.ExtendedInterpolation()
+    parser = configparser.ConfigParser(interpolation=interp)
+    # Default is case-insensitive keys, we need case-sensitive for the
+    # environment variable sections
+    parser.optionxform = lambda option: option
+    parser.read_dict(_DEFAULTS)
+
+    try:
+        path = config_file()
+        with open(path) as f:
+            parser.read_file(f, source=path)
+    except FileNotFoundError:
+        pass  # no config file, use all defaults
+    return parser
+
+
+def cache_files():
+    """For long-running processes: the files that this module's cached data
+    was read from. See invalidate()."""
+    return [config_file()]
 
 
-def _default_op(*args, **kw):
-    val = _config.get(*args, **kw)
+def invalidate():
+    """For long-running processes: forgets the cached config, so that it is
+    read again when it is next needed."""
+    _load.cache_clear()
+
+
+def _default_op(parser, *args, **kw):
+    val = parser.get(*args, **kw)
     return val.strip() if val is not None else None
 
 
@@ -61,34 +88,75 @@ class _Getter:
         self.op = op
 
     def __call__(self):
-        return self.op('Common', self.key, fallback=None)
+        return self.op(_load(), 'Common', self.key, fallback=None)
 
 
-def _string_expandtilde(*args, **kw):
-    val = _config.get(*args, **kw)
+def _string_expandtilde(parser, *args, **kw):
+    val = parser.get(*args, **kw)
     if val is not None:
         return os.path.expanduser(val)
     return val
 
 
-def _ws_sep_list(*args, **kw):
-    val = _config.get(*args, **kw)
+def _ws_sep_list(parser, *args, **kw):
+    val = parser.get(*args, **kw)
     if val is not None:
         return val.split()
     return []
 
 
-def _shell_list(*args, **kw):
-    val = _config.get(*args, **kw)
+def _shell_list(parser, *args, **kw):
+    val = parser.get(*args, **kw)
     if val is not None:
         return shlex.split(val)
     return []
 
 
+_SIZE_SUFFIXES = 'KMGT'
+
+
+def parse_size(text):
+    """Parses a size in bytes, with an optional K, M, G, or T suffix (powers
+    of 1024), such as "20G". Raises ValueError if the size is invalid."""
+    text = text.strip().upper().rstrip('B')
+    multiplier = 1
+    if text and text[-1] in _SIZE_SUFFIXES:
+        multiplier = 1024 ** (_SIZE_SUFFIXES.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+
+def _size(parser, *args, **kw):
+    val = parser.get(*args, **kw)
+    if val is not None:
+        return parse_size(val)
+    return 0
+
+
+def _boolean(parser, *args, **kw):
+    return parser.getboolean(*args, **kw)
+
+
+def _int(parser, *args, **kw):
+    return parser.getint(*args, **kw)
+
+
+def _float(parser, *args, **kw):
+    return parser.getfloat(*args, **kw)
+
+
 workdir = _Getter('workdir', _string_expandtilde)
 checkoutdir = _Getter('checkoutdir', _string_expandtilde)
 shell_prefix = _Getter('shell_prefix')
-user_installation = _Getter('user_installation', _config.getboolean)
+user_installation = _Getter('user_installation', _boolean)
+update_jobs = _Getter('update_jobs', _int)
+remote_catalog_ttl = _Getter('remote_catalog_ttl', _float)
+artifact_cache_dir = _Getter('artifact_cache_dir', _string_expandtilde)
+artifact_cache_size = _Getter('artifact_cache_size', _size)
+builder_cache_size = _Getter('builder_cache_size', _size)
+repo_keep_commits = _Getter('repo_keep_commits', _int)
+use_ccache = _Getter('use_ccache', _boolean)
+ccache_dir = _Getter('ccache_dir', _string_expandtilde)
 sdk_upstream = _Getter('sdk_upstream')
 sdk_upstream_branch = _Getter('sdk_upstream_branch')
 sdk_id = _Getter('sdk_id')
@@ -107,9 +175,10 @@ add_extensions = _Getter('add_extensions', _ws_sep_list)
 class _ModuleGetter(_Getter):
     """Similar to _Getter but for a module-specific config option."""
     def __call__(self, module):
-        if not _config.has_section(module):
+        parser = _load()
+        if not parser.has_section(module):
             return None
-        return self.op(module, self.key, fallback=None)
+        return self.op(parser, module, self.key, fallback=None)
 
 
 module_url = _ModuleGetter('url')
@@ -130,9 +199,10 @@ def module_extra_env(module):
     environment for a specific module, specified by a [$MODULE.extra_env]
     section in the config file."""
     section = module + '.extra_env'
-    if not _config.has_section(section):
+    parser = _load()
+    if not parser.has_section(section):
         return None
-    return {key: value for key, value in _config.items(section)}
+    return {key: value for key, value in parser.items(section)}
 
 
 def manifest():
@@ -141,6 +211,24 @@ def manifest():
     return os.path.join(workdir(), dev_sdk_id() + '.json')
 
 
+def repo():
+    """Returns the path in the workdir of the ostree repo where the dev SDK is
+    exported."""
+    return os.path.join(workdir(), 'repo')
+
+
+def build_dir():
+    """Returns the path in the workdir where flatpak-builder builds the dev
+    SDK."""
+    return os.path.join(workdir(), 'runtime-build')
+
+
+def builder_cache():
+    """Returns the path in the workdir of flatpak-builder's cache
+    directory."""
+    return os.path.join(workdir(), '.flatpak-builder')
+
+
 def upstream_sdk_checkout():
     """Returns the path where the upstream SDK git repo is cloned."""
     sdk_repo_name = sdk_upstream().rsplit('/', 1)[-1]
@@ -0,0 +1,338 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import argparse
+import array
+import hashlib
+import json
+import os
+import os.path
+import select
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+from . import config
+
+"""flapjackd, an optional daemon that keeps flapjack's state warm between
+commands: the parsed config file, the state file, the source and dev tools
+manifests, and the list of installed runtimes. There is one daemon per config
+file, listening on a Unix socket.
+
+When the daemon is running, the flapjack command forwards its command line,
+working directory, environment, and standard streams to it. The daemon checks
+whether any of the files behind its cached data changed, forks, and runs the
+command in the child, which starts out with everything already loaded. If
+the daemon isn't running, flapjack runs the command itself as usual."""
+
+# Commands that may read from the terminal: setup's flatpak install prompt,
+# git asking for credentials in open, and the apps started by run and watch.
+# Commands run by the daemon are in another session, so they can never be in
+# the terminal's foreground process group, and would be stopped if they read
+# from it. These run directly in the terminal instead.
+_INTERACTIVE = ('open', 'run', 'setup', 'shell', 'watch')
+
+# How often the daemon collects its finished child processes, in seconds
+_REAP_INTERVAL = 1
+
+_FDS = (0, 1, 2)
+
+
+def socket_path():
+    """Returns the path of the daemon's socket for the current config file,
+    or None if there is no safe place to put it."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        socket_dir = os.path.join(runtime_dir, 'flapjack')
+    else:
+        socket_dir = os.path.join(tempfile.gettempdir(),
+                                  'flapjack-{}'.format(os.getuid()))
+    try:
+        info = os.stat(socket_dir)
+    except FileNotFoundError:
+        info = None
+    if info is not None and info.st_uid != os.getuid():
+        return None
+
+    config_file = os.path.abspath(config.config_file())
+    name = hashlib.sha1(config_file.encode()).hexdigest()[:16]
+    return os.path.join(socket_dir, name + '.sock')
+
+
+def _is_interactive(command, options):
+    if command in _INTERACTIVE:
+        return True
+    # "flapjack test --shell" opens a shell too
+    return command == 'test' and any(
+        option == '--shell' or
+        (option.startswith('-') and not option.startswith('--') and
+         's' in option)
+        for option in options)
+
+
+def _read_line(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+
+def forward(argv, command, options):
+    """Runs the flapjack command line @argv in the daemon, if it is running.
+    Returns the command's exit code, or None if the command should run in
+    this process instead."""
+
+    if _is_interactive(command, options):
+        return None
+    path = socket_path()
+    if path is None or not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
+        return None  # left over from a daemon that didn't exit cleanly
+
+    with sock:
+        request = json.dumps({
+            'argv': argv,
+            'argv0': sys.argv[0],
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }).encode()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sock.sendmsg([request[:1]], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                      array.array('i', _FDS))])
+        sock.sendall(request[1:])
+        sock.shutdown(socket.SHUT_WR)
+
+        stream = sock.makefile('rb')
+        pid = None
+        while True:
+            try:
+                reply = _read_line(stream)
+            except KeyboardInterrupt:
+                # The command isn't in the terminal's process group, so pass
+                # on the interrupt to it and wait for it to finish
+                if pid is not None:
+                    os.killpg(pid, signal.SIGINT)
+                continue
+            if reply is None:
+                print('flapjackd closed the connection', file=sys.stderr)
+                return 1
+            if 'pid' in reply:
+                pid = reply['pid']
+            if 'exitcode' in reply:
+                return reply['exitcode']
+
+
+def _receive(conn):
+    """Reads a request, and the file descriptors that came with it."""
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(
+        1, socket.CMSG_LEN(len(_FDS) * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                    (len(cmsg_data) % fds.itemsize)])
+
+    chunks = [data]
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    try:
+        request = json.loads(b''.join(chunks).decode())
+    except ValueError:
+        request = None
+    if request is None or len(fds) != len(_FDS):
+        for fd in fds:
+            os.close(fd)
+        raise ValueError('Invalid request')
+    return request, list(fds)
+
+
+def _stat(path):
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return info.st_mtime_ns, info.st_size
+
+
+class _WarmState:
+    """Keeps the caches of the flapjack modules filled, and empties each one
+    when the files it was read from change."""
+
+    def __init__(self):
+        self._fingerprints = {}
+
+    @staticmethod
+    def _modules():
+        # Imported here, since the flapjack command imports this module. The
+        # config goes first, since everything else depends on it
+        from . import ext, state, util
+        return (config, state, util, ext)
+
+    def _clear_all(self):
+        for module in self._modules():
+            module.invalidate()
+        self._fingerprints = {}
+
+    @staticmethod
+    def _preload():
+        from . import ext, state, util
+        for load in (state.get_open_modules, util.get_source_manifest,
+                     util.get_dev_tools_manifest, ext.installed_runtimes):
+            try:
+                load()
+            except Exception:
+                pass  # the command will report it, if it matters
+
+    def refresh(self):
+        """Empties the caches whose files changed, and fills them again."""
+        for module in self._modules():
+            try:
+                fingerprint = [(path, _stat(path))
+                               for path in module.cache_files()]
+            except Exception:
+                fingerprint = None  # the command will report it
+            key = module.__name__
+            if self._fingerprints.get(key, fingerprint) != fingerprint:
+                if module is config:
+                    self._clear_all()
+                else:
+                    module.invalidate()
+            self._fingerprints[key] = fingerprint
+
+        from . import util
+        util.forget_stale_source_manifest()
+        self._preload()
+
+
+def _run_request(conn, request, fds):
+    """Runs the request in a forked child process. Never returns."""
+    exitcode = 1
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.setpgid(0, 0)
+
+        for target, fd in zip(_FDS, fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        # Make git fail instead of stopping if it needs credentials anyway
+        os.environ.setdefault('GIT_TERMINAL_PROMPT', '0')
+        sys.argv = [request['argv0']] + request['argv']
+        conn.sendall(json.dumps({'pid': os.getpid()}).encode() + b'\n')
+
+        from . import main as flapjack_main, trace
+        try:
+            flapjack_main.main(request['argv'], forward=False)
+            exitcode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                exitcode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        trace.write()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(json.dumps({'exitcode': exitcode}).encode() + b'\n')
+        finally:
+            os._exit(0)
+
+
+def _reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def serve(path):
+    """Listens on @path and runs requests until interrupted."""
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        else:
+            print('flapjackd is already running on', path)
+            return 1
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Load everything that commands need up front
+    from . import commands  # noqa
+    warm = _WarmState()
+    warm.refresh()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        sock.bind(path)
+        sock.listen(16)
+        print('flapjackd listening on', path)
+        while True:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            readable, _, _ = select.select([sock], [], [], _REAP_INTERVAL)
+            _reap()
+            if not readable:
+                continue
+
+            conn, _ = sock.accept()
+            with conn:
+                try:
+                    request, fds = _receive(conn)
+                except (OSError, ValueError):
+                    continue
+                warm.refresh()
+                if os.fork() == 0:
+                    sock.close()
+                    _run_request(conn, request, fds)
+                for fd in fds:
+                    os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep flapjack warm between commands. Runs in the '
+                    'foreground until interrupted; the flapjack command uses '
+                    'it automatically while it is running.')
+    parser.parse_args()
+
+    path = socket_path()
+    if path is None:
+        print('No safe directory for the socket. Set XDG_RUNTIME_DIR.')
+        sys.exit(1)
+    sys.exit(serve(path))
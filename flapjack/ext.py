@@ -1,38 +1,90 @@
 # Copyright 2017, 2018 Endless Mobile, Inc.
 
 import collections
+import concurrent.futures
+import configparser
 import contextlib
 import copy
+import functools
+import glob
+import hashlib
 import json
+import os
 import os.path
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 
-from . import config, state, util
+from . import artifacts, ccache, config, history, state, trace, util
 
 """Module for running external commands."""
 
-_BUILD = os.path.join(config.workdir(), 'runtime-build')
-
 verbose_level = 0
 
+# Fixed identity for the temporary commits made by _snapshot(), so that the
+# same tree on top of the same parent always gets the same commit ID, and
+# flatpak-builder's cache for the module stays valid between builds.
+_SNAPSHOT_ENV = {
+    'GIT_AUTHOR_NAME': 'Flapjack',
+    'GIT_AUTHOR_EMAIL': 'flapjack@localhost',
+    'GIT_AUTHOR_DATE': '1970-01-01T00:00:00+0000',
+    'GIT_COMMITTER_NAME': 'Flapjack',
+    'GIT_COMMITTER_EMAIL': 'flapjack@localhost',
+    'GIT_COMMITTER_DATE': '1970-01-01T00:00:00+0000',
+}
+
 
 def print_cmd(cmdline):
     if verbose_level:
         print('FJ:' + ' '.join(cmdline))
 
 
-def git(path, command, *args, output=False, code=False):
-    """Run a git command in the git clone specified by `path`."""
+def print_timing(what, start):
+    """Under --verbose, prints how long something took since @start, which is
+    a value of time.monotonic()."""
+    if verbose_level:
+        print('FJ: {} took {:.2f} s'.format(what, time.monotonic() - start))
+
+
+def _call(func, cmdline, **kwargs):
+    """Calls @func, one of the functions of the subprocess module, with
+    @cmdline, recording a span for the process in the trace."""
+
+    if not trace.enabled():
+        return func(cmdline, **kwargs)
+
+    with trace.span(' '.join(cmdline[:2]), 'subprocess', cmdline=cmdline,
+                    cwd=kwargs.get('cwd') or os.getcwd()) as args:
+        try:
+            result = func(cmdline, **kwargs)
+        except subprocess.CalledProcessError as e:
+            args['exitcode'] = e.returncode
+            raise
+        if func is subprocess.call:
+            args['exitcode'] = result
+        elif func is not subprocess.Popen:
+            args['exitcode'] = 0
+        return result
+
+
+def git(path, command, *args, output=False, code=False, env=None):
+    """Run a git command in the git clone specified by `path`. @env specifies
+    extra environment variables for the command."""
 
     cmdline = ['git', command] + list(args)
     print_cmd(cmdline)
 
+    if env is not None:
+        env = dict(os.environ, **env)
+
     if output:
-        return subprocess.check_output(cmdline, cwd=path,
-                                       universal_newlines=True)
+        return _call(subprocess.check_output, cmdline, cwd=path, env=env,
+                     universal_newlines=True)
     if code:
-        return subprocess.call(cmdline, cwd=path)
-    subprocess.check_call(cmdline, cwd=path)
+        return _call(subprocess.call, cmdline, cwd=path, env=env)
+    _call(subprocess.check_call, cmdline, cwd=path, env=env)
 
 
 def _takes_user_arg(command):
@@ -43,8 +95,9 @@ def _takes_user_arg(command):
                        'remote-ls', 'remotes', 'make-current')
 
 
-def flatpak(command, *args, output=False, code=False):
-    """Run a flatpak command."""
+def flatpak(command, *args, output=False, code=False, background=False):
+    """Run a flatpak command. With @background, don't wait for it to finish,
+    but return the subprocess.Popen object."""
 
     user_arg = []
     if config.user_installation() and _takes_user_arg(command):
@@ -54,15 +107,93 @@ def flatpak(command, *args, output=False, code=False):
     print_cmd(cmdline)
 
     if output:
-        return subprocess.check_output(cmdline, universal_newlines=True)
+        return _call(subprocess.check_output, cmdline,
+                     universal_newlines=True)
+    if code:
+        return _call(subprocess.call, cmdline)
+    if background:
+        return _call(subprocess.Popen, cmdline)
+    _call(subprocess.check_call, cmdline)
+
+
+def ostree(command, *args, output=False, code=False):
+    """Run an ostree command."""
+
+    cmdline = ['ostree', command] + list(args)
+    print_cmd(cmdline)
+
+    if output:
+        return _call(subprocess.check_output, cmdline,
+                     universal_newlines=True)
     if code:
-        return subprocess.call(cmdline)
-    subprocess.check_call(cmdline)
+        return _call(subprocess.call, cmdline)
+    _call(subprocess.check_call, cmdline)
+
+
+@functools.lru_cache()
+def installed_runtimes():
+    """Returns a dict of the installed runtimes, mapping (ID, branch) tuples
+    to the active commit. Queried from flatpak once and then cached; call
+    installed_runtimes.cache_clear() after installing anything."""
+    output = flatpak('list', '--runtime', '--columns=ref,active',
+                     output=True)
+    installed = {}
+    for line in output.splitlines():
+        fields = line.split()
+        # Skip the header line if flatpak prints one
+        if len(fields) != 2 or fields[0].count('/') != 2:
+            continue
+        runtime, _, branch = fields[0].split('/')
+        installed[(runtime, branch)] = fields[1]
+    return installed
+
+
+def cache_files():
+    """For long-running processes: the files that this module's cached data
+    depends on. flatpak touches a .changed file in an installation whenever
+    anything is installed, updated, or removed there, and "flatpak list"
+    covers both the user and the system installation. See invalidate()."""
+    user_dir = os.environ.get('FLATPAK_USER_DIR') or os.path.join(
+        os.environ.get('XDG_DATA_HOME') or
+        os.path.expanduser('~/.local/share'), 'flatpak')
+    system_dir = os.environ.get('FLATPAK_SYSTEM_DIR') or '/var/lib/flatpak'
+    return [os.path.join(user_dir, '.changed'),
+            os.path.join(system_dir, '.changed')]
+
+
+def invalidate():
+    """For long-running processes: forgets the list of installed runtimes,
+    so that it is queried again when it is next needed."""
+    installed_runtimes.cache_clear()
+
+
+def app_info(app):
+    """Returns the directory where @app is deployed, and the app's metadata
+    as a ConfigParser."""
+    location = flatpak('info', '--show-location', app, output=True).strip()
+    metadata = configparser.ConfigParser(interpolation=None)
+    metadata.optionxform = str  # keys are case-sensitive
+    metadata.read_string(flatpak('info', '--show-metadata', app, output=True))
+    return location, metadata
+
+
+def repo_commit(runtime, branch):
+    """Returns the commit of @runtime's @branch in the local repo, read
+    straight from the repo's refs without spawning ostree, or None if the
+    repo doesn't have it."""
+    pattern = os.path.join(glob.escape(config.repo()), 'refs', 'heads',
+                           'runtime', glob.escape(runtime), '*',
+                           glob.escape(branch))
+    for path in glob.glob(pattern):
+        with open(path) as f:
+            return f.read().strip()
+    return None
 
 
 def _generate_manifest():
     source = util.get_source_manifest()
-    manifest = copy.deepcopy(source)
+    manifest = copy.deepcopy(collections.OrderedDict(
+        (key, value) for key, value in source.items() if key != 'modules'))
 
     # Put any changes here that are necessary to remove stuff that only applies
     # to the original runtime's flatpak-builder manifest
@@ -105,10 +236,18 @@ def _generate_manifest():
 
     manifest['add-extensions'] = add_extensions
 
-    # Make sure to maintain order of modules in the output manifest
-    open_modules = [m for m in manifest['modules']
-                    if (m['name'] in state.get_open_modules() and
-                        m['name'] in config.modules())]
+    # Make sure to maintain order of modules in the output manifest. Nested
+    # modules are flattened, since any of them that aren't open come from the
+    # base SDK, and the index already lists them in build order.
+    open_modules = []
+    for name, (_, module) in util.get_module_index().items():
+        if (name not in state.get_open_modules() or
+                name not in config.modules()):
+            continue
+        m = copy.deepcopy(collections.OrderedDict(
+            (key, value) for key, value in module.items() if key != 'modules'))
+        open_modules.append(m)
+
     for m in open_modules:
         m['sources'] = [collections.OrderedDict([
             ('type', 'git'),
@@ -138,6 +277,10 @@ def _generate_manifest():
             build_options.setdefault('env', {})
             build_options['env'].update(config_env)
 
+        if config.use_ccache():
+            build_options.setdefault('env', {})
+            build_options['env'].update(ccache.stats_env(m['name']))
+
         extra_config_opts = config.module_extra_config_opts(m['name'])
         if extra_config_opts:
             # There are two ways to specify config-opts in the manifest, we
@@ -154,92 +297,340 @@ def _generate_manifest():
     return manifest
 
 
-@contextlib.contextmanager
-def _branch_state(path):
-    """Switches a git clone to the "flapjack" branch and makes a temporary
-    commit if necessary. Restores the previous state when exiting the with
-    block. Used in several commands."""
-
-    rev = None
-    changes = False
+def _snapshot(path):
+    """Records the current state of a git clone's working tree, including
+    staged, unstaged, and untracked changes, as a commit on top of HEAD.
+    Returns a tuple of the commit ID, which is HEAD itself if the tree is
+    clean, and the tree ID.
 
-    if (git(path, 'diff', '--quiet', '--cached', '--exit-code',
-            code=True) != 0):
-        raise RuntimeError('{} has staged changes. Currently, "flapjack build"'
-                           ' will clobber them. Please either commit or '
-                           'unstage.'.format(path))
+    This only uses git plumbing with a temporary index, so the working tree,
+    the index, and HEAD of the clone are left untouched. The commit is made
+    with a fixed author, committer, and date, so the same sources always give
+    the same commit ID."""
 
-    if os.path.exists(os.path.join(path, '.git', 'MERGE_HEAD')):
+    # .git may be a file pointing elsewhere, as in worktrees and submodules
+    git_dir, head, head_tree = git(path, 'rev-parse', '--git-dir', 'HEAD',
+                                   'HEAD^{tree}', output=True).splitlines()
+    git_dir = os.path.join(path, git_dir)
+    if os.path.exists(os.path.join(git_dir, 'MERGE_HEAD')):
         raise RuntimeError('{} is in the middle of a merge. Please finish it '
                            'before building.'.format(path))
 
-    rev = git(path, 'rev-parse', '--abbrev-ref', 'HEAD', output=True)
-    rev = rev.strip()
-
-    git(path, 'checkout', '-B', 'flapjack')
-
-    changes = bool(git(path, 'status', '--porcelain', output=True))
-    if changes:
-        git(path, 'add', '.')
-        git(path, 'commit', '--message', 'Temporary commit for Flapjack')
-
+    # Start from a copy of the real index, so that git can use its cached
+    # stat information and only needs to hash the files that changed
+    fd, index = tempfile.mkstemp(prefix='flapjack-index.', dir=git_dir)
+    os.close(fd)
     try:
-        yield
+        try:
+            shutil.copyfile(os.path.join(git_dir, 'index'), index)
+        except FileNotFoundError:
+            os.unlink(index)
+        env = dict(_SNAPSHOT_ENV, GIT_INDEX_FILE=index)
+        git(path, 'add', '--all', env=env)
+        tree = git(path, 'write-tree', output=True, env=env).strip()
     finally:
-        if changes:
-            git(path, 'reset', 'HEAD^')
-        git(path, 'checkout', rev)
-
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(index)
+
+    if tree == head_tree:
+        return head, tree
+    # A signature would make the commit ID differ for identical trees, and
+    # might ask for a passphrase
+    commit = git(path, 'commit-tree', '--no-gpg-sign', tree, '-p', head, '-m',
+                 'Temporary commit for Flapjack', output=True,
+                 env=_SNAPSHOT_ENV).strip()
+    return commit, tree
+
+
+def _git_query(path, *args):
+    """Runs a git command that exits with 1 when what it looks up doesn't
+    exist. Returns its output, or None in that case."""
+    try:
+        return git(path, *args, output=True).strip()
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1:
+            return None
+        raise
 
-class _BranchAllModules(contextlib.ExitStack):
-    def __enter__(self):
-        for module in state.get_open_modules():
-            git_clone = os.path.join(config.checkoutdir(), module)
-            self.enter_context(_branch_state(git_clone))
 
+@contextlib.contextmanager
+def _branch_state(path):
+    """Points a git clone's "flapjack" branch at a snapshot of its working
+    tree (see _snapshot()) for the duration of the with block, which gets the
+    commit and tree IDs. If the with block raises an exception, the branch is
+    put back where it was. Used in several commands."""
+
+    if _git_query(path, 'symbolic-ref', '-q', 'HEAD') == 'refs/heads/flapjack':
+        raise RuntimeError('{} has the "flapjack" branch checked out. '
+                           'Please switch to another branch before '
+                           'building.'.format(path))
+
+    previous = _git_query(path, 'rev-parse', '-q', '--verify',
+                          'refs/heads/flapjack')
+    commit, tree = _snapshot(path)
+    git(path, 'update-ref', 'refs/heads/flapjack', commit)
+    try:
+        yield commit, tree
+    except Exception:
+        if previous is None:
+            git(path, 'update-ref', '-d', 'refs/heads/flapjack')
+        else:
+            git(path, 'update-ref', 'refs/heads/flapjack', previous)
+        raise
+
+
+def _in_parallel(func, items):
+    """Calls @func on each of @items in a thread of its own, and returns the
+    futures once they are all done."""
+    if not items:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(len(items)) as pool:
+        futures = [pool.submit(func, item) for item in items]
+    return futures
+
+
+class _BranchAllModules:
+    """Enters _branch_state() for all open modules in parallel, and exits
+    them in parallel as well. If preparing any module fails, the modules that
+    were already prepared are rolled back before the error is raised. The
+    snapshot commit and tree of each module are available in the `commits`
+    and `trees` dicts."""
+
+    def __init__(self):
+        self._contexts = []
+        self.commits = collections.OrderedDict()
+        self.trees = collections.OrderedDict()
+
+    def _enter_module(self, module):
+        start = time.monotonic()
+        context = _branch_state(os.path.join(config.checkoutdir(), module))
+        with trace.span('prepare ' + module, 'phase'):
+            snapshot = context.__enter__()
+        print_timing('preparing ' + module, start)
+        return context, snapshot
+
+    def _exit_all(self, *exc_info):
+        def exit_module(item):
+            module, context = item
+            start = time.monotonic()
+            with trace.span('restore ' + module, 'phase'):
+                context.__exit__(*exc_info)
+            print_timing('restoring ' + module, start)
+
+        for future in _in_parallel(exit_module, self._contexts):
+            future.result()
+        self._contexts = []
 
-def flatpak_builder(*args, check=None, distcheck=False):
+    def __enter__(self):
+        modules = state.get_open_modules()
+        futures = _in_parallel(self._enter_module, modules)
+
+        error = None
+        for module, future in zip(modules, futures):
+            try:
+                context, (commit, tree) = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            self._contexts.append((module, context))
+            self.commits[module] = commit
+            self.trees[module] = tree
+
+        if error is not None:
+            self._exit_all(type(error), error, error.__traceback__)
+            raise error
+        return self
+
+    def __exit__(self, *exc_info):
+        self._exit_all(*exc_info)
+        return False
+
+
+def _clear_build_dir():
+    """Moves the previous build directory aside and deletes it in a detached
+    process, so that flatpak-builder's --force-clean has nothing to delete
+    and the build can start right away. Also deletes any old build
+    directories left over from earlier runs that didn't get that far."""
+
+    build_dir = config.build_dir()
+    leftovers = glob.glob(glob.escape(build_dir) + '.old-*')
+    if os.path.exists(build_dir):
+        # A fresh directory can't collide with a leftover that is still
+        # being deleted
+        old_dir = tempfile.mkdtemp(
+            dir=config.workdir(), prefix=os.path.basename(build_dir) + '.old-')
+        os.rename(build_dir, os.path.join(old_dir, 'build'))
+        leftovers.append(old_dir)
+
+    if leftovers:
+        cmdline = ['rm', '-rf', '--'] + leftovers
+        print_cmd(cmdline)
+        _call(subprocess.Popen, cmdline, stdin=subprocess.DEVNULL,
+              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+              start_new_session=True)
+
+
+def _serialize_manifest(manifest):
+    return json.dumps(manifest, indent=4)
+
+
+def _hash(data):
+    serialized = json.dumps(data, sort_keys=True).encode()
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def _build_inputs(manifest, commits):
+    """Summarizes what goes into building the generated @manifest, given the
+    snapshot @commits of the open modules: the base SDK's commit, a hash of
+    the manifest's top-level keys, and for each module in build order, its
+    name, a hash of its definition, and its commit if it is open."""
+    sdk_commit = installed_runtimes().get((config.sdk_id(),
+                                           config.sdk_branch()))
+    modules = []
+    for m in manifest['modules']:
+        if not isinstance(m, dict):
+            modules.append((m, _hash(m), None))
+            continue
+        modules.append((m['name'], _hash(m), commits.get(m['name'])))
+    return {
+        'sdk': sdk_commit,
+        'global': _hash({key: value for key, value in manifest.items()
+                         if key != 'modules'}),
+        'modules': modules,
+    }
+
+
+def build_inputs():
+    """Returns what would go into building the dev SDK right now, in the same
+    form as recorded in the state file after a successful build. The open
+    modules are snapshotted, but not switched to their flapjack branches."""
+    modules = state.get_open_modules()
+    futures = _in_parallel(
+        lambda m: _snapshot(os.path.join(config.checkoutdir(), m)), modules)
+    commits = {m: future.result()[0] for m, future in zip(modules, futures)}
+    with trace.span('generate manifest', 'phase'):
+        manifest = _generate_manifest()
+    return _build_inputs(manifest, commits)
+
+
+def _write_manifest(manifest):
+    """Writes the generated manifest, unless the file already has exactly the
+    same contents, so that its modification time only changes when it does.
+    The file is replaced atomically."""
+    contents = _serialize_manifest(manifest)
+    try:
+        with open(config.manifest()) as f:
+            if f.read() == contents:
+                return
+    except FileNotFoundError:
+        pass
+
+    tmpname = config.manifest() + '.tmp'
+    with open(tmpname, 'w') as f:
+        f.write(contents)
+    os.replace(tmpname, config.manifest())
+
+
+def _run_builder(cmdline, command):
+    """Runs flatpak-builder, passing its output through while recording how
+    long each part of the build takes in the build history. Returns the exit
+    code."""
+
+    # The build shell is interactive, so leave it alone
+    if any(arg.startswith('--build-shell') for arg in cmdline):
+        return _call(subprocess.call, cmdline, cwd=config.workdir())
+
+    recorder = history.Recorder(command)
+    sys.stdout.flush()
+    with trace.span('flatpak-builder', 'subprocess', cmdline=cmdline,
+                    cwd=config.workdir()) as trace_args:
+        # The messages that the recorder follows are all on stdout, so
+        # errors on stderr go straight to flapjack's stderr
+        process = subprocess.Popen(cmdline, cwd=config.workdir(),
+                                   stdout=subprocess.PIPE)
+        with process.stdout:
+            for line in iter(process.stdout.readline, b''):
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+                recorder.feed(line.decode(errors='replace'))
+        exitcode = trace_args['exitcode'] = process.wait()
+    history.append(recorder.finish(exitcode))
+    return exitcode
+
+
+def flatpak_builder(*args, check=None, distcheck=False, skip_unchanged=False):
     """Run flatpak-builder to build the dev runtime, generating and writing a
     flatpak-builder manifest. @check specifies a module for which to run the
-    tests."""
-
-    manifest = _generate_manifest()
-
-    stop_arg = []
-    if check:
-        check_index, check_module = next(
-            (ix, m) for ix, m in enumerate(manifest['modules'])
-            if isinstance(m, dict) and m['name'] == check)
-        testcmds = ['make distcheck'] if distcheck else ['make check']
-        if check_module.get('buildsystem', None) == 'meson':
-            testcmds = ['ninja test']
-        override_testcmds = check_module.get('test-commands', None)
-        if override_testcmds is not None:
-            testcmds = override_testcmds
-
-        build_commands = check_module.setdefault('build-commands', [])
-        build_commands[0:0] = testcmds
-
-        build_options = check_module.setdefault('build-options', {})
-        build_options['build-args'] = (config.test_permissions() +
-                                       build_options.get('build-args', []))
-
-        try:
-            next_module = manifest['modules'][check_index + 1]['name']
-            stop_arg = ['--stop-at={}'.format(next_module)]
-        except IndexError:
-            pass  # checked module was the last module
-
-    with open(config.manifest(), 'w') as f:
-        json.dump(manifest, f, indent=4)
-
-    verbose = []
-    if verbose_level > 1:
-        verbose = ['--verbose']
-
-    cmdline = (['flatpak-builder', '--force-clean'] + verbose +
-               list(args) + stop_arg + [_BUILD, config.manifest()])
-    print_cmd(cmdline)
-
-    with _BranchAllModules():
-        return subprocess.call(cmdline, cwd=config.workdir())
+    tests. If @skip_unchanged is given, the build is skipped and None is
+    returned if neither the manifest, the open modules, nor the base SDK have
+    changed since the last successful build with @skip_unchanged, and the
+    local repo still has the dev SDK that it exported."""
+
+    with _BranchAllModules() as branches:
+        with trace.span('generate manifest', 'phase'):
+            manifest = _generate_manifest()
+
+        # The artifact cache rewrites the manifest depending on what is in the
+        # cache, so the build's inputs are taken from the manifest before that
+        inputs = _build_inputs(manifest, branches.commits)
+        if (skip_unchanged and state.get_last_build() == inputs and
+                repo_commit(config.dev_sdk_id(), 'master') is not None):
+            print('Nothing to do, the runtime is up to date')
+            return None
+
+        use_artifacts = check is None and artifacts.enabled()
+        if use_artifacts:
+            with trace.span('apply artifact cache', 'phase'):
+                artifacts.apply(manifest, branches.trees, inputs['sdk'])
+
+        stop_arg = []
+        if check:
+            positions = {m['name']: ix
+                         for ix, m in enumerate(manifest['modules'])
+                         if isinstance(m, dict)}
+            check_index = positions[check]
+            check_module = manifest['modules'][check_index]
+            testcmds = ['make distcheck'] if distcheck else ['make check']
+            if check_module.get('buildsystem', None) == 'meson':
+                testcmds = ['ninja test']
+            override_testcmds = check_module.get('test-commands', None)
+            if override_testcmds is not None:
+                testcmds = override_testcmds
+
+            build_commands = check_module.setdefault('build-commands', [])
+            build_commands[0:0] = testcmds
+
+            build_options = check_module.setdefault('build-options', {})
+            build_options['build-args'] = (
+                config.test_permissions() +
+                build_options.get('build-args', []))
+
+            try:
+                next_module = manifest['modules'][check_index + 1]['name']
+                stop_arg = ['--stop-at={}'.format(next_module)]
+            except IndexError:
+                pass  # checked module was the last module
+
+        _write_manifest(manifest)
+
+        verbose = []
+        if verbose_level > 1:
+            verbose = ['--verbose']
+
+        ccache_arg = []
+        if config.use_ccache():
+            ccache.setup()
+            ccache_arg = ['--ccache']
+
+        cmdline = (['flatpak-builder', '--force-clean'] + verbose +
+                   ccache_arg + list(args) + stop_arg +
+                   [config.build_dir(), config.manifest()])
+        print_cmd(cmdline)
+
+        _clear_build_dir()
+        exitcode = _run_builder(cmdline, 'test' if check else 'build')
+        if exitcode == 0 and use_artifacts:
+            artifacts.finish()
+        if exitcode == 0 and skip_unchanged:
+            state.set_last_build(inputs)
+        return exitcode
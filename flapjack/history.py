@@ -0,0 +1,142 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import collections
+import json
+import os
+import os.path
+import re
+import time
+
+from . import config
+
+"""Records how long each part of a flatpak-builder run takes, by following the
+messages that flatpak-builder prints as it goes along. The history of recent
+builds is kept in the workdir, one JSON object per line."""
+
+_MAX_ENTRIES = 100
+
+_BUILDING = re.compile(r'Building module (\S+)')
+_CACHE_HIT = re.compile(r'Cache hit for (\S+),')
+_COMMITTING = re.compile(r'Committing stage (\S+) to cache')
+_INSTALLING = re.compile(r'Running: .*\binstall\b')
+
+# Messages that start a stage of the build that doesn't belong to a module
+_STAGES = (
+    (re.compile(r'Downloading sources'), 'download'),
+    (re.compile(r'Cleaning up'), 'cleanup'),
+    (re.compile(r'Finishing '), 'finish'),
+    (re.compile(r'Exporting '), 'export'),
+)
+
+
+class Recorder:
+    """Follows the output of a flatpak-builder run, one line at a time, and
+    keeps track of how long each stage and each module took, and which modules
+    were cache hits."""
+
+    def __init__(self, command):
+        self._command = command
+        self._start = time.monotonic()
+        self._stage = ('init', None)
+        self._stage_start = self._start
+        self._stages = collections.OrderedDict()
+        self._modules = collections.OrderedDict()
+
+    def _enter(self, stage, module=None):
+        now = time.monotonic()
+        previous, previous_module = self._stage
+        times = (self._stages if previous_module is None
+                 else self._modules[previous_module]['times'])
+        times[previous] = times.get(previous, 0) + now - self._stage_start
+        self._stage = (stage, module)
+        self._stage_start = now
+
+    def _module(self, name, cache):
+        entry = self._modules.setdefault(name, {'times': {}})
+        entry['cache'] = cache
+
+    def feed(self, line):
+        line = line.strip()
+
+        match = _BUILDING.match(line)
+        if match:
+            self._module(match.group(1), 'miss')
+            self._enter('build', match.group(1))
+            return
+
+        match = _CACHE_HIT.match(line)
+        if match:
+            self._module(match.group(1), 'hit')
+            self._enter('checkout', match.group(1))
+            return
+
+        match = _COMMITTING.match(line)
+        if match:
+            stage = match.group(1)
+            module = stage[len('build-'):]
+            if stage.startswith('build-') and module in self._modules:
+                self._enter('commit', module)
+            else:
+                self._enter('commit')
+            return
+
+        stage, module = self._stage
+        if (module is not None and stage == 'build' and
+                _INSTALLING.match(line)):
+            self._enter('install', module)
+            return
+
+        for pattern, stage in _STAGES:
+            if pattern.match(line):
+                self._enter(stage)
+                return
+
+    def finish(self, exitcode):
+        """Returns the history entry for the build, which ended with
+        @exitcode."""
+        self._enter(None)
+        return {
+            'time': time.time(),
+            'command': self._command,
+            'exitcode': exitcode,
+            'total': time.monotonic() - self._start,
+            'stages': self._stages,
+            'modules': self._modules,
+        }
+
+
+def _filename():
+    return os.path.join(config.workdir(), 'build-history.json')
+
+
+def read():
+    """Returns the recorded builds, oldest first."""
+    entries = []
+    try:
+        with open(_filename()) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass  # a line cut short by a crash
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def append(entry):
+    """Adds @entry to the history, forgetting the oldest builds if there are
+    too many."""
+    entries = read()[-(_MAX_ENTRIES - 1):] + [entry]
+    tmpname = _filename() + '.tmp'
+    with open(tmpname, 'w') as f:
+        for each in entries:
+            f.write(json.dumps(each) + '\n')
+    os.replace(tmpname, _filename())
+
+
+def clear():
+    try:
+        os.unlink(_filename())
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,77 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import ctypes
+import os
+import select
+import struct
+
+"""Minimal wrapper around the Linux inotify API, using ctypes so that flapjack
+doesn't need any Python modules outside the standard library."""
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events that mean something in a directory changed
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+# The symbols in the process's own namespace include libc's
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _check(result):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+class Watcher:
+    """Watches directories for changes. Each event is returned as a tuple
+    of (watched directory, name of the file inside it, event mask)."""
+
+    def __init__(self):
+        self._fd = _check(_libc.inotify_init1(os.O_CLOEXEC))
+        self._paths = {}
+
+    def add_watch(self, path, mask=IN_CHANGES):
+        wd = _check(_libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                            mask | IN_ONLYDIR))
+        self._paths[wd] = path
+
+    def read(self, timeout=None):
+        """Returns a list of events, waiting at most @timeout seconds for one
+        to arrive, or forever if @timeout is None. Returns an empty list if
+        the timeout expired."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self._fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            events.append((self._paths.get(wd), os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self._fd)
@@ -18,59 +18,31 @@ Contributers:
 """MIT license - https://github.com/getify/JSON.minify/tree/python"""
 
 
-def json_minify(string, strip_space=True):
-    tokenizer = re.compile('"|(/\*)|(\*/)|(//)|\n|\r')
-    end_slashes_re = re.compile(r'(\\)*$')
-
-    in_string = False
-    in_multi = False
-    in_single = False
-
-    new_str = []
-    index = 0
-
-    for match in re.finditer(tokenizer, string):
+# Strings are matched as a whole so that comment markers and white space
+# inside them are left alone. Unterminated strings and comments run to the end
+# of the input.
+_TOKENIZER = re.compile(r'''
+    "(?:[^"\\]|\\.)*(?:"|\Z)    # string
+  | /\*.*?(?:\*/|\Z)           # multi-line comment
+  | //[^\r\n]*                 # single-line comment
+  | [\ \t\n\r]+               # white space as defined in the standard
+''', re.DOTALL | re.VERBOSE)
 
-        if not (in_multi or in_single):
-            tmp = string[index:match.start()]
-            if not in_string and strip_space:
-                # replace white space as defined in standard
-                tmp = re.sub('[ \t\n\r]+', '', tmp)
-            new_str.append(tmp)
-        elif not strip_space:
-            # Replace comments with white space so that the JSON parser reports
-            # the correct column numbers on parsing errors.
-            new_str.append(' ' * (match.start() - index))
 
-        index = match.end()
-        val = match.group()
+def _blank(text):
+    # Replace comments with white space so that the JSON parser reports the
+    # correct line and column numbers on parsing errors.
+    return ''.join(c if c in '\r\n' else ' ' for c in text)
 
-        if val == '"' and not (in_multi or in_single):
-            escaped = end_slashes_re.search(string, 0, match.start())
 
-            # start of string or unescaped quote character to end string
-            if not in_string or (escaped is None or len(escaped.group()) % 2 == 0):  # noqa
-                in_string = not in_string
-            index -= 1  # include " character in next catch
-        elif not (in_string or in_multi or in_single):
-            if val == '/*':
-                in_multi = True
-            elif val == '//':
-                in_single = True
-        elif val == '*/' and in_multi and not (in_string or in_single):
-            in_multi = False
-            if not strip_space:
-                new_str.append(' ' * len(val))
-        elif val in '\r\n' and not (in_multi or in_string) and in_single:
-            in_single = False
-        elif not ((in_multi or in_single) or (val in ' \r\n\t' and strip_space)):  # noqa
-            new_str.append(val)
-
-        if not strip_space:
-            if val in '\r\n':
-                new_str.append(val)
-            elif in_multi or in_single:
-                new_str.append(' ' * len(val))
-
-    new_str.append(string[index:])
-    return ''.join(new_str)
+def json_minify(string, strip_space=True):
+    def replace(match):
+        token = match.group()
+        if token[0] == '"':
+            return token
+        if token[0] == '/':
+            return '' if strip_space else _blank(token)
+        return '' if strip_space else token
+
+    # A single pass over the input, so this takes linear time
+    return _TOKENIZER.sub(replace, string)
@@ -1,15 +1,18 @@
 # Copyright 2017 Endless Mobile, Inc.
 
 import argparse
+import os
 import sys
 
-from . import __version__, commands
+from . import __version__, registry
 
 
-def main():
+def main(argv=None, forward=True):
+    """Runs flapjack with the command line @argv, sys.argv by default. If
+    @forward is True and flapjackd is running, the command is run there."""
     DESCRIPTION = ('Developer workflow for building a flatpak runtime while ' +
                    'developing one or more of the components in it.')
-    EPILOG = ('Subcommands are:\n' + commands.get_help_text() +
+    EPILOG = ('Subcommands are:\n' + registry.get_help_text() +
               '\nFor more information run flapjack <command> --help\n')
 
     parser = argparse.ArgumentParser(
@@ -18,19 +21,39 @@ def main():
     parser.add_argument('--version', action='version',
                         version='%(prog)s {}'.format(__version__.__version__))
     parser.add_argument('--verbose', '-v', action='count')
+    parser.add_argument('--trace', metavar='FILE',
+                        default=os.environ.get('FLAPJACK_TRACE'),
+                        help='Write a trace of what flapjack spends its time '
+                             'on to FILE, in Chrome trace-event format '
+                             '(default: $FLAPJACK_TRACE)')
     parser.add_argument('command', help='Subcommand to run')
     parser.add_argument('options', nargs=argparse.REMAINDER,
                         help='Options for subcommand')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    if args.verbose:
-        commands.set_verbose(args.verbose)
-
-    try:
-        command = commands.get_command(args.command)
-    except KeyError:
+    if args.command not in registry.COMMANDS:
         print('Unknown command "{}"'.format(args.command))
         parser.print_help()
         sys.exit(1)
 
+    if forward:
+        from . import daemon
+        exitcode = daemon.forward(
+            sys.argv[1:] if argv is None else argv, args.command,
+            args.options)
+        if exitcode is not None:
+            sys.exit(exitcode)
+
+    # Only import the commands, and everything they need, when actually
+    # running one; this keeps --help and tab completion fast
+    from . import commands
+
+    if args.trace:
+        from . import trace
+        trace.enable(args.trace)
+
+    if args.verbose:
+        commands.set_verbose(args.verbose)
+
+    command = commands.get_command(args.command)
     sys.exit(command.run(args.options))
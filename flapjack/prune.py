@@ -0,0 +1,230 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import glob
+import os
+import os.path
+import re
+import shutil
+import time
+
+from . import config, ext, util
+
+"""Module for trimming flapjack's disk usage without throwing everything away.
+
+The local repo keeps the last few commits of each ref that flapjack exports
+there, and the objects that they use.
+
+flatpak-builder's cache directory holds the cached build stages (as refs in an
+ostree repo), downloaded sources, git mirrors, kept build directories, and
+ccache data. The stage refs don't record when they were last used, so only the
+ones that the current manifest no longer uses are removed, a batch at a time,
+and the cache is measured again after each batch, since the objects they use
+may be shared. The other parts are pruned least recently used first, going by
+their modification times."""
+
+_AGE_SUFFIXES = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_age(text):
+    """Parses an age such as "14d", "12h", "30m", or "2w" into seconds. A
+    plain number is taken as days. Raises ValueError if the age is invalid."""
+    text = text.strip().lower()
+    multiplier = _AGE_SUFFIXES['d']
+    if text and text[-1] in _AGE_SUFFIXES:
+        multiplier = _AGE_SUFFIXES[text[-1]]
+        text = text[:-1]
+    return float(text) * multiplier
+
+
+def disk_usage(path):
+    """Total size in bytes of the files under @path."""
+    if not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except FileNotFoundError:
+            return 0
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _last_used(path):
+    """Most recent modification time of @path or anything under it."""
+    latest = os.lstat(path).st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest,
+                             os.lstat(os.path.join(dirpath, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+    return latest
+
+
+def _builder_cache_entries(cache_dir):
+    """Returns a list of (last used, size, path) tuples for all the things in
+    flatpak-builder's cache, apart from the cached stages, that can be removed
+    individually."""
+
+    entries = []
+    for subdir in ('downloads', 'git', 'bzr', 'svn', 'build'):
+        top = os.path.join(cache_dir, subdir)
+        if not os.path.isdir(top):
+            continue
+        for name in os.listdir(top):
+            path = os.path.join(top, name)
+            entries.append((_last_used(path), disk_usage(path), path))
+
+    # If ccache_dir is in use, the ccache directory is a symlink to data that
+    # is shared with other workdirs, so leave it alone
+    ccache_dir = os.path.join(cache_dir, 'ccache')
+    if not os.path.islink(ccache_dir):
+        for dirpath, _, filenames in os.walk(ccache_dir):
+            if dirpath == ccache_dir:
+                continue  # configuration and top-level statistics
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                info = os.lstat(path)
+                entries.append((info.st_mtime, info.st_size, path))
+
+    return entries
+
+
+def _stage_name(module_name):
+    """flatpak-builder's name for the stage that builds a module, as it
+    appears in the cache repo's refs."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', 'build-' + module_name)
+
+
+def _module_names(modules, base_dir):
+    for module in modules:
+        if isinstance(module, str):
+            path = os.path.join(base_dir, module)
+            module, base_dir = util._load_json(path), os.path.dirname(path)
+        yield module['name']
+        yield from _module_names(module.get('modules', []), base_dir)
+
+
+def _count_refs(repo_dir):
+    refs_dir = os.path.join(repo_dir, 'refs', 'heads')
+    return sum(len(filenames) for _, _, filenames in os.walk(refs_dir))
+
+
+def _unused_stage_refs(cache_dir):
+    """Returns a list of (modification time, path) tuples for the stage refs in
+    flatpak-builder's cache repo that the last generated manifest doesn't use:
+    the stages of modules that are no longer in it, and everything cached for
+    other manifests. If the manifest can't be read, no refs are returned."""
+
+    try:
+        manifest = util._load_json(config.manifest())
+        used = {_stage_name(name) for name in _module_names(
+            manifest['modules'], os.path.dirname(config.manifest()))}
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+    refs_dir = os.path.join(cache_dir, 'cache', 'refs', 'heads')
+    branch_dir = os.path.join(refs_dir, os.path.basename(config.manifest()))
+    refs = []
+    for dirpath, _, filenames in os.walk(refs_dir):
+        for name in filenames:
+            if (dirpath == branch_dir and
+                    (not name.startswith('build-') or name in used)):
+                continue
+            path = os.path.join(dirpath, name)
+            refs.append((os.lstat(path).st_mtime, path))
+    return refs
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.unlink(path)
+
+
+def prune_builder_cache(max_size=None, older_than=None, only_if_fits=False):
+    """Removes entries from flatpak-builder's cache that haven't been used for
+    @older_than seconds, and then the least recently used ones until the cache
+    is no bigger than @max_size bytes. Cached stages are only removed if the
+    current manifest no longer uses them, oldest first. If @only_if_fits is
+    given, nothing but unused stages is removed unless that gets the cache
+    under @max_size, so that sources aren't downloaded again on every build
+    when the stages alone are too big. Returns the number of bytes freed."""
+
+    cache_dir = config.builder_cache()
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    before = disk_usage(cache_dir)
+    total = before
+    cutoff = None if older_than is None else time.time() - older_than
+
+    # Pruning the cache repo goes through all of it, so the stage refs are
+    # removed in batches: the ones that are too old, and then as many of the
+    # oldest as would get the cache under @max_size if each took up an equal
+    # share of the repo. Stages share objects, so that may not be enough; each
+    # further batch is then at least twice as big as the one before.
+    repo_dir = os.path.join(cache_dir, 'cache')
+    refs = sorted(_unused_stage_refs(cache_dir))
+    count = 0
+    if cutoff is not None:
+        count = len([ref for ref in refs if ref[0] < cutoff])
+    share = 1
+    if max_size is not None and total > max_size and refs:
+        share = max(disk_usage(repo_dir) // _count_refs(repo_dir), 1)
+    removed = batch = 0
+    while True:
+        if max_size is not None and total > max_size:
+            batch = max((total - max_size + share - 1) // share, 2 * batch)
+            count = max(count, removed + batch)
+        count = min(count, len(refs))
+        if count <= removed:
+            break
+        for _, path in refs[removed:count]:
+            os.unlink(path)
+        removed = count
+        ext.ostree('prune', '--repo=' + repo_dir, '--refs-only')
+        total = disk_usage(cache_dir)
+
+    entries = sorted(_builder_cache_entries(cache_dir))
+    if (only_if_fits and max_size is not None and
+            total - sum(size for _, size, _ in entries) > max_size):
+        entries = []
+    for last_used, size, path in entries:
+        too_old = cutoff is not None and last_used < cutoff
+        too_big = max_size is not None and total > max_size
+        if not too_old and not too_big:
+            continue
+        _remove(path)
+        total -= size
+
+    return before - disk_usage(cache_dir)
+
+
+def prune_repo(keep_commits):
+    """Deletes all but the newest @keep_commits commits of each ref in the
+    local repo, or none of them if @keep_commits is 0, and then all objects
+    that are no longer used."""
+    args = ['--repo=' + config.repo(), '--refs-only']
+    if keep_commits > 0:
+        args.append('--depth={}'.format(keep_commits - 1))
+    ext.ostree('prune', *args)
+
+
+def remove_build_dirs():
+    """Removes flatpak-builder's build directory, and any old ones that are
+    still waiting to be deleted. Returns the number of bytes freed."""
+    build_dir = config.build_dir()
+    freed = 0
+    for path in [build_dir] + glob.glob(glob.escape(build_dir) + '.old-*'):
+        if not os.path.isdir(path):
+            continue
+        freed += disk_usage(path)
+        shutil.rmtree(path, ignore_errors=True)
+    return freed
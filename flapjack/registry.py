@@ -0,0 +1,65 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+"""Static description of flapjack's subcommands. This is separate from the
+commands module so that the help text and the tab completion script can be
+produced without importing the commands, reading the config file, or building
+any argument parsers. When adding a command, add an entry here with the same
+one-line description as the command class's docstring."""
+
+# Kinds of positional parameters that a command takes, used for tab completion.
+# A command whose positional parameter is one of a fixed set of words has a
+# tuple of those words instead.
+MODULE = 'module'
+APP = 'app'
+
+# name: (description, kind of positional parameter or None)
+COMMANDS = {
+    'build': ('Build a development flatpak runtime', None),
+    'clean-cache': ('Clean the flatpak-builder cache', None),
+    'close': ('Close development on a module and remove it from the runtime',
+              MODULE),
+    'gc': ('Free disk space used by old builds', None),
+    'list': ('List the modules available for development', None),
+    'open': ('Open a module for development, putting it in the runtime',
+             MODULE),
+    'plan': ('Show which modules the next build will rebuild', None),
+    'run': ('Run an app against the development runtime', APP),
+    'setup': ('Get set up to use flapjack for the first time', None),
+    'shell': ("Open a shell in the development runtime's sandbox", None),
+    'stats': ('Show statistics about builds and caches', ('build', 'ccache')),
+    'test': ('Build a module and run its tests', MODULE),
+    'update': ('Update your runtimes and git checkouts', None),
+    'watch': ('Rebuild the development runtime when open modules change',
+              APP),
+}
+
+
+def get_all_commands():
+    """Get all commands grouped by their parameter requirements."""
+    commands = {
+        'all': sorted(COMMANDS.keys()),
+        'requiring module': [],
+        'requiring app': [],
+        'no params': [],
+        'choices': {},
+    }
+    for name in commands['all']:
+        params = COMMANDS[name][1]
+        if params == MODULE:
+            commands['requiring module'].append(name)
+        elif params == APP:
+            commands['requiring app'].append(name)
+        elif isinstance(params, tuple):
+            commands['choices'][name] = list(params)
+        else:
+            commands['no params'].append(name)
+
+    return commands
+
+
+def get_help_text():
+    """One line of each command name and description."""
+    retval = ''
+    for cmd in sorted(COMMANDS.keys()):
+        retval += '  {:12} {}\n'.format(cmd, COMMANDS[cmd][0])
+    return retval
@@ -9,18 +9,21 @@ from . import config
 instead of XDG_CACHE_DIR so that you can maintain multiple Flapjack
 checkouts if you are hacking on more than one runtime."""
 
-_FILENAME = os.path.join(config.workdir(), 'state.dat')
+
+def _filename():
+    return os.path.join(config.workdir(), 'state.dat')
 
 
 class _State:
     def __init__(self):
         self.open_modules = []
+        self.last_build = None
 
 
 @functools.lru_cache()
 def _read_state():
     try:
-        with open(_FILENAME, 'rb') as f:
+        with open(_filename(), 'rb') as f:
             return pickle.load(f)
     except FileNotFoundError:
         default_state = _State()
@@ -29,11 +32,23 @@ def _read_state():
 
 
 def _write_state(state):
-    with open(_FILENAME, 'wb') as f:
+    with open(_filename(), 'wb') as f:
         pickle.dump(state, f)
     _read_state.cache_clear()
 
 
+def cache_files():
+    """For long-running processes: the files that this module's cached data
+    was read from. See invalidate()."""
+    return [_filename()]
+
+
+def invalidate():
+    """For long-running processes: forgets the cached state, so that it is
+    read again when it is next needed."""
+    _read_state.cache_clear()
+
+
 def get_open_modules():
     return copy.deepcopy(_read_state().open_modules)
 
@@ -42,3 +57,16 @@ def set_open_modules(modules):
     state = _read_state()
     state.open_modules = copy.deepcopy(modules)
     _write_state(state)
+
+
+def get_last_build():
+    """Returns what went into the last successful build of the dev SDK, as
+    recorded by set_last_build(), or None."""
+    # State files written by older versions don't have this attribute
+    return copy.deepcopy(getattr(_read_state(), 'last_build', None))
+
+
+def set_last_build(inputs):
+    state = _read_state()
+    state.last_build = copy.deepcopy(inputs)
+    _write_state(state)
@@ -0,0 +1,93 @@
+# Copyright 2017 Endless Mobile, Inc.
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+"""Records what flapjack spends its time on, as a trace in the Chrome
+trace-event format, which can be loaded in chrome://tracing or in Perfetto.
+Tracing is turned on with the --trace option or the FLAPJACK_TRACE environment
+variable, and costs next to nothing when it is off."""
+
+_filename = None
+_pid = None
+_events = []
+_lock = threading.Lock()
+_thread_names = {}
+
+
+def enable(filename):
+    """Starts recording spans, and writes them to @filename when flapjack
+    exits."""
+    global _filename, _pid
+    if _filename is None:
+        atexit.register(write)
+    _filename = filename
+    _pid = os.getpid()
+
+
+def enabled():
+    """Returns whether spans are being recorded, for callers that would have
+    to do some work to describe a span."""
+    return _filename is not None
+
+
+def _microseconds(monotonic):
+    return int(monotonic * 1000000)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Records a span called @name around the body of the with statement.
+    @args are shown with the span in the trace viewer. The dict of arguments
+    is yielded, so that more of them, such as an exit code, can be added
+    before the span ends."""
+    if not enabled():
+        yield args
+        return
+
+    start = time.monotonic()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        end = time.monotonic()
+        thread = threading.current_thread()
+        with _lock:
+            _thread_names[thread.ident] = thread.name
+            _events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': _microseconds(start),
+                'dur': _microseconds(end - start),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args,
+            })
+
+
+def write():
+    """Writes the trace file. This happens automatically when flapjack exits,
+    except in processes that leave through os._exit()."""
+    pid = os.getpid()
+    if _filename is None or pid != _pid:
+        return  # not tracing, or a forked child process
+    with _lock:
+        metadata = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': tid,
+            'args': {'name': name},
+        } for tid, name in _thread_names.items()]
+        events = metadata + _events
+
+    with open(_filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                  default=str)
@@ -3,22 +3,156 @@
 import collections
 import functools
 import json
+import os
+import os.path
+import pickle
 
 from . import config
 from .json_minify import json_minify
 
 
-@functools.lru_cache()
-def get_source_manifest():
-    with open(config.source_manifest()) as f:
+def format_size(size):
+    """Formats a number of bytes for humans."""
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    if unit == 'bytes':
+        return '{} {}'.format(int(size), unit)
+    return '{:.1f} {}'.format(size, unit)
+
+
+def format_duration(seconds):
+    """Formats a number of seconds for humans."""
+    if seconds < 60:
+        return '{:.1f}s'.format(seconds)
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return '{}m {:02}s'.format(minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h {:02}m'.format(hours, minutes)
+
+
+def _load_json(path):
+    with open(path) as f:
         # Sadly, the GNOME manifest has comments in it.
         data = json_minify(f.read())
         return json.loads(data, object_pairs_hook=collections.OrderedDict)
 
 
+def _file_key(path):
+    info = os.stat(path)
+    return (path, info.st_mtime_ns, info.st_size)
+
+
+def _resolve_modules(modules, base_dir, files, index):
+    """Replaces the entries in @modules that are paths to JSON files with the
+    module that they contain, relative to @base_dir, and does the same for any
+    nested modules. Appends the keys of the included files to @files, and adds
+    each module to @index, children before their parent."""
+    for ix, module in enumerate(modules):
+        path = None
+        if isinstance(module, str):
+            path = os.path.normpath(os.path.join(base_dir, module))
+            files.append(_file_key(path))
+            module = modules[ix] = _load_json(path)
+
+        module_dir = base_dir if path is None else os.path.dirname(path)
+        _resolve_modules(module.get('modules', []), module_dir, files, index)
+        index[module['name']] = (path, module)
+
+
+def _manifest_cache_file():
+    return os.path.join(config.workdir(), 'manifest-cache.dat')
+
+
+def _read_manifest_cache():
+    """Returns the cached (files, manifest, index) tuple, or None if the cache
+    is missing or any of the files that went into it has changed since."""
+    try:
+        with open(_manifest_cache_file(), 'rb') as f:
+            files, manifest, index = pickle.load(f)
+        if files[0][0] != config.source_manifest():
+            return None
+        if any(_file_key(key[0]) != key for key in files):
+            return None
+    except (FileNotFoundError, EOFError, ValueError, pickle.PickleError):
+        return None
+    return files, manifest, index
+
+
+def _write_manifest_cache(files, manifest, index):
+    tmpname = _manifest_cache_file() + '.tmp'
+    with open(tmpname, 'wb') as f:
+        pickle.dump((files, manifest, index), f)
+    os.replace(tmpname, _manifest_cache_file())
+
+
+@functools.lru_cache()
+def _load_source_manifest():
+    cached = _read_manifest_cache()
+    if cached is not None:
+        return cached
+
+    path = config.source_manifest()
+    files = [_file_key(path)]
+    manifest = _load_json(path)
+    index = collections.OrderedDict()
+    _resolve_modules(manifest.get('modules', []), os.path.dirname(path),
+                     files, index)
+    _write_manifest_cache(files, manifest, index)
+    return files, manifest, index
+
+
+def forget_stale_source_manifest():
+    """For long-running processes: drops the source manifest from memory if
+    any of the files that it was read from changed since."""
+    if not _load_source_manifest.cache_info().currsize:
+        return
+    files = _load_source_manifest()[0]
+    try:
+        if all(_file_key(key[0]) == key for key in files):
+            return
+    except FileNotFoundError:
+        pass
+    _load_source_manifest.cache_clear()
+
+
+def get_source_manifest():
+    """Returns the parsed source manifest, with modules included from other
+    files resolved. Parsing it is slow, so the result is also cached in the
+    workdir for as long as none of the files involved change."""
+    return _load_source_manifest()[1]
+
+
+def get_module_index():
+    """Returns an ordered dictionary mapping the names of all the modules in
+    the source manifest, including nested ones, to a tuple of the file that the
+    module was included from (None if it was defined inline) and the module's
+    definition. Nested modules come before the module that contains them, in
+    the order that flatpak-builder builds them."""
+    return _load_source_manifest()[2]
+
+
 @functools.lru_cache()
 def get_dev_tools_manifest():
     if not config.dev_tools_manifest():
         return []
     with open(config.dev_tools_manifest()) as f:
         return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+def cache_files():
+    """For long-running processes: the files that this module's cached data
+    was read from, apart from the source manifest's, which
+    forget_stale_source_manifest() checks. See invalidate()."""
+    return [config.dev_tools_manifest()] if config.dev_tools_manifest() else []
+
+
+def invalidate():
+    """For long-running processes: forgets the cached manifests, so that they
+    are read again when they are next needed."""
+    get_dev_tools_manifest.cache_clear()
+    _load_source_manifest.cache_clear()
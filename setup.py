@@ -139,7 +139,10 @@ setup(
 
     packages=find_packages(),
     entry_points={
-        'console_scripts': ['flapjack=flapjack.main:main'],
+        'console_scripts': [
+            'flapjack=flapjack.main:main',
+            'flapjackd=flapjack.daemon:main',
+        ],
     },
 
     install_requires=[],